@@ -0,0 +1,424 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import time
+import tracemalloc
+
+import cuckoo
+import ecc
+import imagewriter
+import metrics
+import pdatamap
+import registry
+import shamir
+import synthetic
+import util
+import voucherstore
+import wire
+
+from client import Client, Triple, Voucher, VoucherGenerator
+from Crypto.PublicKey import ECC
+from Crypto.Random import get_random_bytes
+from server import ClientState, Server, VoucherDecryptor
+
+results = list()  # all reported results, written as JSON with --json
+current = None  # name of the running benchmark
+
+
+def measure(func, args, repeat=3):
+    """Calls func once per argument and returns the best mean time per call in microseconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for a in args:
+            func(a)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(args) * 1e6
+
+
+def report(name, us, base_us=None, unit="us"):
+    """Prints one benchmark result, optionally with the speedup against a baseline"""
+    results.append({'benchmark': current, 'name': name, 'value': us, 'unit': unit, 'baseline': base_us})
+    if base_us is None:
+        print(f"{name:<40} {us:>10.1f} {unit}")
+    else:
+        print(f"{name:<40} {us:>10.1f} {unit}  {base_us / us:>5.2f}x")
+
+
+def bench_fixed_base(n=200):
+    """Fixed-base comb tables against plain ECC.EccPoint multiplication"""
+    scalars = [random.randrange(ecc.q) for _ in range(n)]
+    G = ECC.EccPoint(x=ecc.G[0], y=ecc.G[1], curve='p256')
+    L_tuple = ecc.mul_base(random.randrange(ecc.q))
+    L = ECC.EccPoint(x=L_tuple[0], y=L_tuple[1], curve='p256')
+
+    start = time.perf_counter()
+    ecc.fixed_base(ecc.G)
+    ecc.fixed_base(L_tuple)
+    report("build comb tables for G and L", (time.perf_counter() - start) * 1e6)
+
+    # the protocol needs affine coordinates, so the conversion is part of the baseline
+    base = measure(lambda k: (k * G).xy, scalars)
+    report("EccPoint k * G", base)
+    report("comb k * G", measure(ecc.mul_base, scalars), base)
+    base = measure(lambda k: (k * L).xy, scalars)
+    report("EccPoint k * L", base)
+    report("comb k * L", measure(ecc.fixed_base(L_tuple).mul, scalars), base)
+
+
+def bench_decrypt(n=100):
+    """VoucherDecryptor against the per-voucher EccPoint multiplication and trial decryption"""
+    alpha = random.randrange(ecc.q)
+    vouchers = list()
+    for i in range(n):
+        Q1 = ecc.mul_base(random.randrange(ecc.q))
+        Q2 = ecc.mul_base(random.randrange(ecc.q))
+        rkey = get_random_bytes(16)
+        ct1 = util.aes128_enc(util.calc_H_dash(ecc.mul(alpha, Q1)), rkey)
+        ct2 = util.aes128_enc(get_random_bytes(16), rkey)
+        vouchers.append(Voucher(i, Q1, ct1, Q2, ct2, None))
+
+    def plain(v):
+        rkeys = list()
+        for Q, ct in ((v.Q1, v.ct1), (v.Q2, v.ct2)):
+            S = alpha * ECC.EccPoint(x=Q[0], y=Q[1], curve='p256')
+            rkeys.append(util.aes128_dec(util.calc_H_dash((int(S.x), None)), ct))
+        return rkeys
+
+    base = measure(plain, vouchers)
+    report("EccPoint per voucher", base)
+    decryptor = VoucherDecryptor(alpha)
+    report("VoucherDecryptor per voucher", measure(decryptor.recover, [vouchers]) / n, base)
+
+
+def bench_cuckoo(sizes=(10 ** 4, 10 ** 5, 10 ** 6), e_dash=0.3):
+    """Hashing X and building the cuckoo table for growing synthetic X"""
+    for n in sizes:
+        X = ['%024x' % random.getrandbits(96) for _ in range(n)]
+        n_dash = int((1 + e_dash) * n)
+        start = time.perf_counter()
+        h1 = util.calc_h_many(X, n_dash, 0)
+        h2 = util.calc_h_many(X, n_dash, 1)
+        hashed = time.perf_counter()
+        table = cuckoo.CuckooTable(n_dash, h1, h2).build()
+        built = time.perf_counter()
+        st = table.stats()
+        report(f"n={n}, hash X", (hashed - start) * 1e6)
+        report(f"n={n}, build", (built - hashed) * 1e6)
+        report(f"n={n}, load factor", st['load_factor'] * 100, unit="%")
+        report(f"n={n}, stashed and discarded", st['stashed'] + st['discarded'], unit="")
+
+
+def bench_update(n=10 ** 4, updates=20):
+    """Adding and removing single hashes of X against setting up a new server"""
+    X = ['%024x' % random.getrandbits(96) for _ in range(n)]
+    start = time.perf_counter()
+    server = Server("Bench", X=X)
+    base = (time.perf_counter() - start) * 1e6
+    report(f"server setup with {n} hashes", base)
+    new = ['%024x' % random.getrandbits(96) for _ in range(updates)]
+    report("add_to_X, one hash", measure(lambda x: server.add_to_X([x]), new, repeat=1), base)
+    report("remove_from_X, one hash", measure(lambda x: server.remove_from_X([x]), new, repeat=1), base)
+
+
+def bench_bulk(n=10 ** 3, x=10 ** 3):
+    """Sending the vouchers of many triples one by one against add_triples with a worker pool"""
+    server = Server("Bench", X=[f"{i:024x}" for i in range(x)])
+    triples = [(f"{random.getrandbits(96):024x}", i, get_random_bytes(1024)) for i in range(2 * n)]
+    util.log_level = util.QUIET
+    client = Client("one-by-one", server)
+    server.add_clients([client], create_dirs=False)
+    start = time.perf_counter()
+    for t in triples[:n]:
+        client.add_triple(*t)
+    base = (time.perf_counter() - start) / n * 1e6
+    report("add_triple", base)
+    client = Client("bulk", server)
+    server.add_clients([client], create_dirs=False)
+    workers = os.cpu_count()
+    start = time.perf_counter()
+    client.add_triples(triples[n:], workers=workers)
+    report(f"add_triples, {workers} processes", (time.perf_counter() - start) / n * 1e6, base)
+    util.log_level = util.INFO
+
+
+def bench_pdata(n=10 ** 4, lookups=10 ** 4):
+    """Memory and lookup time of a decoded pdata list against the encoded pdata with decoding on access"""
+    points = [ecc.mul_base(random.randrange(1, util.ecc_q)) for _ in range(n)]
+    payload = wire.PARAMS_HEADER.pack(3, n - 1, 0, 1, 0) + b"".join(wire.encode_point(P) for P in points)
+    off = wire.PARAMS_HEADER.size
+    start = time.perf_counter()
+    pdata = [wire.decode_point(payload[i:i + wire.POINT_LEN]) for i in range(off, len(payload), wire.POINT_LEN)]
+    base = (time.perf_counter() - start) * 1e6
+    report(f"decode {n} points", base)
+    start = time.perf_counter()
+    pmap = pdatamap.PdataMap(payload, capacity=lookups // 10)
+    report("PdataMap", (time.perf_counter() - start) * 1e6, base)
+    slots = [random.randrange(n) for _ in range(lookups)]
+    hot = random.sample(range(n), lookups // 10)
+    base = measure(pdata.__getitem__, slots)
+    report("list lookup", base)
+    report("PdataMap lookup, uncached", measure(pmap.__getitem__, slots, repeat=1), base)
+    pmap.lru.clear()
+    report("PdataMap lookup, hot slots", measure(pmap.__getitem__, hot * 10), base)
+    # memory of the 1000 first points, decoded and in a map with all of them cached
+    tracemalloc.start()
+    pdata = [wire.decode_point(payload[i:i + wire.POINT_LEN]) for i in range(off, off + 1000 * wire.POINT_LEN,
+                                                                              wire.POINT_LEN)]
+    base = tracemalloc.get_traced_memory()[0] / 1000
+    tracemalloc.stop()
+    report("decoded list, bytes per point", base, unit="B")
+    report("PdataMap, bytes per point", wire.POINT_LEN, base, unit="B")
+    tracemalloc.start()
+    pmap = pdatamap.PdataMap(payload, capacity=1000)
+    for i in range(1000):
+        pmap[i]
+    report("PdataMap, cached, bytes per point", tracemalloc.get_traced_memory()[0] / 1000 + wire.POINT_LEN, base,
+           unit="B")
+    tracemalloc.stop()
+
+
+def bench_store(n=2 * 10 ** 4):
+    """Memory of n vouchers in the columnar store against a list of Voucher objects"""
+    key = get_random_bytes(16)
+    tracemalloc.start()
+    vouchers = list()
+    for i in range(n):
+        # only the sizes matter, so the points are not on the curve and rct is a 64-byte dummy
+        Q1 = (random.getrandbits(256), random.getrandbits(256))
+        Q2 = (random.getrandbits(256), random.getrandbits(256))
+        ct1 = util.aes128_enc(key, get_random_bytes(16))
+        ct2 = util.aes128_enc(key, get_random_bytes(16))
+        vouchers.append(Voucher(i, Q1, ct1, Q2, ct2, util.aes128_enc(key, get_random_bytes(64))))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    report("Voucher objects, bytes per voucher", size / n, unit="B")
+    store = voucherstore.VoucherStore()
+    start = time.perf_counter()
+    for v in vouchers:
+        store.append(0, v)
+    report("VoucherStore.append", (time.perf_counter() - start) / n * 1e6)
+    report("VoucherStore, bytes per voucher", store.nbytes() / n, unit="B")
+
+
+def bench_clients(n=10 ** 6, lookups=10 ** 5, deletes=10 ** 4):
+    """Registering, routing to and deleting clients in the registry against the former parallel lists"""
+    clients = list()
+    for i in range(n):
+        # the registry only needs the ID, so the secrets are not drawn
+        client = Client.__new__(Client)
+        client.id = f"client-{i}"
+        clients.append(client)
+    reg = registry.ClientRegistry()
+    start = time.perf_counter()
+    reg.add_many(clients, ClientState)
+    report(f"add_many, {n} clients", (time.perf_counter() - start) * 1e6)
+    ids = [c.id for c in random.sample(clients, lookups)]
+    report("handle lookup", measure(reg.handle, ids))
+    id_list = [c.id for c in clients]
+    report("list index lookup", measure(id_list.index, ids[:20], repeat=1))
+    start = time.perf_counter()
+    for client_id in ids[:deletes]:
+        reg.remove(client_id)
+    report("remove", (time.perf_counter() - start) / deletes * 1e6)
+    start = time.perf_counter()
+    for client_id in ids[:20]:
+        index = id_list.index(client_id)
+        id_list.pop(index)
+    report("list index and pop", (time.perf_counter() - start) / 20 * 1e6)
+
+
+def recon_naive(shares):
+    """Former Lagrange reconstruction with one modular inversion per pair of shares"""
+    adkey = 0
+    for v in shares:
+        temp = 1
+        for other in shares:
+            if v is not other:
+                temp = (temp * (0 - other[0] * pow(v[0] - other[0], -1, shamir.p))) % shamir.p
+        adkey = (adkey + temp * v[1]) % shamir.p
+    return adkey
+
+
+def bench_shamir(ts=(3, 12, 24, 48), n=20):
+    """Share generation and adkey reconstruction for growing thresholds"""
+    for t in ts:
+        pol = util.init_sh_poly(get_random_bytes(16), t)
+        xs = [random.randrange(1, shamir.p) for _ in range(2 * t + 2)]
+        base = measure(lambda x: sum(pol[i] * x ** i for i in range(len(pol))) % shamir.p, xs)
+        report(f"t={t}, x ** i share", base)
+        report(f"t={t}, Horner share", measure(lambda x: shamir.evaluate(pol, x), xs), base)
+        share_sets = [[(x, shamir.evaluate(pol, x)) for x in random.sample(xs, t + 1)] for _ in range(n)]
+        base = measure(recon_naive, share_sets, repeat=1)
+        report(f"t={t}, pairwise inversions", base)
+        shamir.weights.cache_clear()
+        shamir.lagrange_coefficients.cache_clear()
+        report(f"t={t}, batch inversion", measure(shamir.interpolate, share_sets, repeat=1), base)
+        report(f"t={t}, cached coefficients", measure(shamir.interpolate, share_sets), base)
+        # twice the threshold with a quarter of the shares corrupted
+        shares = [(x, shamir.evaluate(pol, x)) for x in xs]
+        for i in random.sample(range(len(shares)), len(shares) // 4):
+            shares[i] = (shares[i][0], shares[i][1] + 1)
+        adkey, bad = shamir.reconstruct(shares, t)
+        assert adkey == pol[0] and len(bad) == len(shares) // 4
+        report(f"t={t}, decoded {len(bad)} bad of {len(shares)}",
+               measure(lambda s: shamir.reconstruct(s, t), [shares], repeat=1))
+
+
+def bench_primitives(sizes=(2 ** 10, 2 ** 16, 2 ** 20), ts=(3, 12, 48)):
+    """The hash functions, AES-GCM across plaintext sizes and the shamir polynomial across thresholds"""
+    ys = synthetic.hashes(1000)
+    report("calc_h", measure(lambda y: util.calc_h(y, 13000, 0, 1), ys))
+    report("calc_H", measure(util.calc_H, ys[:200]))
+    points = [util.calc_H(y) for y in ys[:200]]
+    report("calc_H_dash", measure(util.calc_H_dash, points))
+    key = get_random_bytes(16)
+    for size in sizes:
+        data = [get_random_bytes(size)] * max(10, 2 ** 22 // size)
+        report(f"aes128_enc, {size} B", measure(lambda d: util.aes128_enc(key, d), data))
+        cts = [util.aes128_enc(key, d) for d in data]
+        report(f"aes128_dec, {size} B", measure(lambda ct: util.aes128_dec(key, ct), cts))
+    for t in ts:
+        pol = util.init_sh_poly(get_random_bytes(16), t)
+        xs = [random.randrange(1, util.sh_p) for _ in range(200)]
+        report(f"calc_poly, t={t}", measure(lambda x: util.calc_poly(x, pol), xs))
+        # every reconstruction gets new x, so no Lagrange coefficients are cached
+        share_sets = [[(x, util.calc_poly(x, pol)) for x in random.sample(xs, t + 1)] for _ in range(20)]
+        report(f"recon_adkey, t={t}", measure(util.recon_adkey, share_sets, repeat=1))
+
+
+def bench_setup(sizes=(10 ** 3, 10 ** 4)):
+    """Cuckoo table and pdata of the server setup for growing synthetic X"""
+    for n in sizes:
+        server = synthetic.server(n)
+        report(f"create_cuckoo_table, n={n}", measure(lambda _: server.create_cuckoo_table(), [None], repeat=1))
+        report(f"calc_pdata, n={n}", measure(lambda _: server.calc_pdata(), [None], repeat=1))
+
+
+def bench_protocol(ts=(3, 12), x=10 ** 3, clients=4, m=50, match_fraction=0.5):
+    """generate_voucher and process_vouchers per voucher, for synthetic clients of which half the triples
+    match X"""
+    util.log_level = util.QUIET
+    for t in ts:
+        server = synthetic.server(x, t)
+        vouchers = list()
+        start = time.perf_counter()
+        for client in synthetic.clients(server, clients):
+            triples = [Triple(*tr) for tr in synthetic.triples(server, m, match_fraction)]
+            vouchers.append((client, [client.generate_voucher(tr) for tr in triples]))
+        report(f"generate_voucher, t={t}", (time.perf_counter() - start) / (clients * m) * 1e6)
+        for client, batch in vouchers:
+            server.receive_vouchers(client, batch)
+        start = time.perf_counter()
+        _, OUTSET = server.process_vouchers()
+        report(f"process_vouchers, t={t}", (time.perf_counter() - start) / (clients * m) * 1e6)
+        report(f"decrypted ADs, t={t}", sum(len(o) for o in OUTSET), unit="")
+    util.log_level = util.INFO
+
+
+def bench_metrics(n=200, x=10 ** 3):
+    """Voucher generation and recovery with metrics recording off and on"""
+    s = synthetic.server(x)
+    client = synthetic.clients(s, 1, "metrics")[0]
+    gen = VoucherGenerator(client)
+    triples = [Triple(*t) for t in synthetic.triples(s, n, 0.5, 0)]
+    vouchers = [gen.generate(t) for t in triples]
+    decryptor = VoucherDecryptor(s.alpha)
+    report("disabled check", measure(lambda _: metrics.enabled and metrics.inc("x"), range(10 ** 5)) * 1e3,
+           unit="ns")
+    report("disabled phases.mark", measure(lambda _: metrics.phases("x").mark("y"), range(10 ** 5)) * 1e3,
+           unit="ns")
+    off_gen = measure(gen.generate, triples)
+    off_rec = measure(decryptor.recover, [vouchers]) / n
+    metrics.enable()
+    try:
+        report("generate_voucher, metrics off", off_gen)
+        report("generate_voucher, metrics on", measure(gen.generate, triples), off_gen)
+        report("recover per voucher, metrics off", off_rec)
+        report("recover per voucher, metrics on", measure(decryptor.recover, [vouchers]) / n, off_rec)
+    finally:
+        metrics.enable(False)
+        metrics.reset()
+
+
+def bench_images(n=500, size=2 ** 17, work_us=500):
+    """Saving decrypted images with fsync between units of processing work, in line against the ImageWriter"""
+    images = [(i, get_random_bytes(size)) for i in range(n)]
+
+    def work():
+        end = time.perf_counter() + work_us / 1e6
+        while time.perf_counter() < end:
+            pass
+
+    def inline(path):
+        os.makedirs(path, exist_ok=True)
+        for t in images:
+            work()
+            util.save_image(t, path, True)
+
+    def behind(path):
+        writer = imagewriter.ImageWriter()
+        for t in images:
+            work()
+            writer.save(path, *t)
+        writer.close()
+
+    base = measure(inline, [f"{util.dec_img_dir}inline-{i}/" for i in range(3)], 1) / n
+    report("in line per image", base)
+    report("ImageWriter per image", measure(behind, [f"{util.dec_img_dir}behind-{i}/" for i in range(3)], 1) / n,
+           base)
+
+
+benchmarks = {
+    'primitives': bench_primitives,
+    'setup': bench_setup,
+    'protocol': bench_protocol,
+    'fixed_base': bench_fixed_base,
+    'decrypt': bench_decrypt,
+    'cuckoo': bench_cuckoo,
+    'update': bench_update,
+    'bulk': bench_bulk,
+    'store': bench_store,
+    'pdata': bench_pdata,
+    'clients': bench_clients,
+    'shamir': bench_shamir,
+    'metrics': bench_metrics,
+    'images': bench_images,
+}
+
+
+def git_commit():
+    """Returns the commit of the benchmarked tree, None outside of a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the benchmarks headless in a temporary root directory")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run, all by default: {', '.join(benchmarks)}")
+    parser.add_argument("--json", metavar="PATH", help="write all results as JSON to compare them between commits")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in benchmarks]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    root = synthetic.use_temp_root("tpsi-bench-")
+    started = time.time()
+    try:
+        for current in args.names or benchmarks:
+            print(f"--- {current}")
+            benchmarks[current]()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+                       'started': started, 'results': results}, f, indent=1)
+        print(f"results written to {args.json}")
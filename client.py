@@ -1,32 +1,278 @@
-import json
+import ecc
+import functools
+import itertools
+import metrics
+import multiprocessing.pool
+import os
 import random
+import shamir
+import threading
 import util
+import wire
+
+from collections import deque
 
 from Crypto.Random import get_random_bytes
-from Crypto.PublicKey import ECC
 
 
-class Triple:
-    """Representation of a triple"""
+class Record:
+    """Base of records with __slots__, pickled as a tuple of their fields"""
+    __slots__ = ()
+
+    def __getstate__(self):
+        # memoryviews into a received buffer cannot be pickled
+        return tuple(bytes(v) if isinstance(v, memoryview) else v for v in (getattr(self, k) for k in self.__slots__))
+
+    def __setstate__(self, state):
+        # pickles from before __slots__ hold the instance dict, fields added later default to None
+        if isinstance(state, dict):
+            state = [state.get(k) for k in self.__slots__]
+        for k, v in itertools.zip_longest(self.__slots__, state):
+            setattr(self, k, v)
+
+
+class Triple(Record):
+    """Representation of a triple, ad holds the image or the path of a file streamed from disk"""
+    __slots__ = ('y', 'id', 'ad')
+
     def __init__(self, y, id, ad):
         self.y = y
         self.id = id
         self.ad = ad
 
 
-class Voucher:
+class Voucher(Record):
     """Representation of a voucher"""
-    def __init__(self, id, Q1, ct1, Q2, ct2, rct):
+    __slots__ = ('id', 'Q1', 'ct1', 'Q2', 'ct2', 'rct', 'adref')
+
+    def __init__(self, id, Q1, ct1, Q2, ct2, rct, adref=None):
         self.id = id
         self.Q1 = Q1
         self.ct1 = ct1
         self.Q2 = Q2
         self.ct2 = ct2
         self.rct = rct
+        self.adref = adref  # (offset, length) of a streamed adct in the server's AD segment
+
+    def to_bytes(self):
+        """Encodes the voucher: 8-byte id, then Q1, ct1, Q2, ct2 and rct, points compressed to 33 bytes,
+        followed by offset and length of a streamed adct"""
+        parts = [wire.ID.pack(self.id), wire.encode_point(self.Q1), self.ct1,
+                 wire.encode_point(self.Q2), self.ct2, self.rct]
+        if self.adref is not None:
+            parts.append(wire.ADREF.pack(*self.adref))
+        return b"".join(parts)
+
+    @staticmethod
+    def from_bytes(buf):
+        """Decodes a voucher, the ciphertexts are memoryviews into buf, raises ValueError for vouchers no
+        client generates: Q1 or Q2 at infinity or ct1 and ct2 not holding a 16-byte rkey"""
+        mv = memoryview(buf)
+        id = wire.ID.unpack_from(mv)[0]
+        off = wire.ID.size
+        Q1 = wire.decode_point(mv[off:off + wire.POINT_LEN])
+        ct1, off = wire.split_ciphertext(mv, off + wire.POINT_LEN)
+        Q2 = wire.decode_point(mv[off:off + wire.POINT_LEN])
+        ct2, off = wire.split_ciphertext(mv, off + wire.POINT_LEN)
+        rct, off = wire.split_ciphertext(mv, off)
+        if Q1 is None or Q2 is None:
+            raise ValueError("point at infinity in voucher")
+        if len(ct1) != wire.RKEY_CT_LEN or len(ct2) != wire.RKEY_CT_LEN:
+            raise ValueError("ct1 and ct2 must hold a 16-byte rkey")
+        adref = None
+        if len(mv) - off == wire.ADREF.size:
+            adref = wire.ADREF.unpack_from(mv, off)
+        elif off != len(mv):
+            raise ValueError("trailing bytes after voucher")
+        return Voucher(id, Q1, ct1, Q2, ct2, rct, adref)
+
+
+def draw_randomness(L):
+    """Draws the triple-independent randomness of a voucher: rkey and (gamma, gamma * L) for both halves"""
+    # gamma * G is not needed, Q is computed as the single product (beta * h + gamma) * G
+    table = ecc.fixed_base(tuple(L))
+    gamma1 = random.randint(0, util.ecc_q)
+    gamma2 = random.randint(0, util.ecc_q)
+    return get_random_bytes(16), (gamma1, table.mul(gamma1)), (gamma2, table.mul(gamma2))
+
+
+class RandomnessPool:
+    """Pool of precomputed voucher randomness, refilled in bulk or by a background thread"""
+    def __init__(self, L, size=256, watermark=64, background=True):
+        self.L = L
+        self.size = size  # number of entries after a refill
+        self.watermark = watermark  # a background refill starts below this number of entries
+        self.background = background
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.refilling = False
+
+    def fill(self):
+        """Precomputes entries until the pool is full"""
+        while len(self.items) < self.size:
+            self.items.append(draw_randomness(self.L))
+
+    def refill(self):
+        """Fills the pool and marks the background refill as finished"""
+        try:
+            self.fill()
+        finally:
+            with self.lock:
+                self.refilling = False
+
+    def start_refill(self):
+        """Starts a background refill unless one is running, the lock must be held"""
+        if not self.refilling:
+            self.refilling = True
+            threading.Thread(target=self.refill, daemon=True).start()
+
+    def start(self):
+        """Starts filling the pool in the background right away, before the first entry is taken"""
+        with self.lock:
+            self.start_refill()
+
+    def take(self):
+        """Takes an entry from the pool, draws a fresh one if the pool is empty"""
+        with self.lock:
+            item = self.items.popleft() if len(self.items) > 0 else None
+            if self.background and len(self.items) < self.watermark:
+                self.start_refill()
+        if item is None:
+            item = draw_randomness(self.L)
+        return item
+
+
+class VoucherGenerator:
+    """Secrets of a client and the server parameters a voucher depends on, without the server itself,
+    so that vouchers can be generated in worker threads or processes"""
+    def __init__(self, client):
+        self.adkey = client.adkey
+        self.fkey = client.fkey
+        self.shamir_secret = client.shamir_secret
+        self.pdata = client.pdata
+        self.n_dash = client.server.n_dash
+        self.h1_index = client.server.h1_index
+        self.h2_index = client.server.h2_index
+
+    def generate(self, triple, randomness=None):
+        """Generates a voucher for a triple according to tPSI-AD protocol, the AD of a triple holding a file
+        path is streamed separately and its voucher gets an empty adct"""
+        phases = metrics.phases("generate_voucher")
+        # step 1
+        adct = b"" if isinstance(triple.ad, str) else util.aes128_enc(self.adkey, triple.ad)
+        phases.mark("step1")
+        # step 2
+        prf_sh_x, prf_sh_z, prf_x, prf_r = util.calc_prf(self.fkey, triple.id)
+        phases.mark("step2")
+        # step 3
+        sh_z = shamir.evaluate(self.shamir_secret, prf_sh_x)
+        phases.mark("step3")
+        # step 4
+        if randomness is None:
+            randomness = draw_randomness(self.pdata[0])
+        rkey, (gamma1, gamma1_L), (gamma2, gamma2_L) = randomness
+        rct = util.aes128_enc(rkey, wire.encode_rct(adct, prf_sh_x, sh_z))
+        phases.mark("step4")
+        # step 5.1
+        w1, w2 = util.calc_h(triple.y, self.n_dash, self.h1_index, self.h2_index)
+        # step 5.2
+        h = util.calc_H_int(triple.y)  # H(y) = h * G, computed once per triple
+        beta1 = random.randint(0, util.ecc_q)
+        beta2 = random.randint(0, util.ecc_q)
+        # Q = beta * H(y) + gamma * G = (beta * h + gamma) * G
+        Q1 = ecc.mul_base(beta1 * h + gamma1)
+        Q2 = ecc.mul_base(beta2 * h + gamma2)
+        P_w1 = self.pdata[w1 + 1]
+        P_w2 = self.pdata[w2 + 1]
+        # S = beta * P_w + gamma * L, gamma * L was drawn together with gamma
+        S1 = ecc.add(ecc.mul(beta1, P_w1), gamma1_L)
+        S2 = ecc.add(ecc.mul(beta2, P_w2), gamma2_L)
+        # step 5.3
+        H_dash_S1 = util.calc_H_dash(S1)
+        H_dash_S2 = util.calc_H_dash(S2)
+        ct1 = util.aes128_enc(H_dash_S1, rkey)
+        ct2 = util.aes128_enc(H_dash_S2, rkey)
+        phases.mark("step5")
+        # step 6
+        if random.randint(1, 2) == 1:
+            voucher = Voucher(triple.id, Q1, ct1, Q2, ct2, rct)
+        else:
+            voucher = Voucher(triple.id, Q2, ct2, Q1, ct1, rct)
+        phases.mark("step6")
+        return voucher
+
+
+generators = dict()  # VoucherGenerator of every pool by key, set in the workers of that pool
+pool_keys = itertools.count()
+
+
+def init_generator(key, gen):
+    """Sets the VoucherGenerator of a pool in a worker"""
+    generators[key] = gen
+
+
+def generate_voucher(key, triple, randomness):
+    """Generates a voucher with the VoucherGenerator of the pool with the given key, bind the key with
+    functools.partial to pass this to a pool"""
+    return generators[key].generate(triple, randomness)
+
+
+class GeneratorPool:
+    """VoucherGenerator of a client with an optional pool of workers holding a copy of it. A generator keeps
+    the pdata and hash parameters it was built with, so generator and pool are replaced once the pdata version
+    of the client changes, batches still running on the old pool finish there"""
+    def __init__(self, client, workers=0, processes=True):
+        self.client = client
+        self.workers = workers  # size of the pool, 0 for generating in the calling thread
+        self.processes = processes  # worker processes, else threads
+        self.lock = threading.Lock()
+        self.version = None  # pdata version of the generator
+        self.generator = None
+        self.pool = None
+        self.func = None  # generate_voucher bound to the key of the pool
+        self.keys = list()
+        self.retired = list()  # pools of older generators, joined by close
+
+    def current(self):
+        """Returns the generator for the current pdata of the client, its pool or None and the function that
+        generates a voucher from (triple, randomness) in the pool"""
+        with self.lock:
+            if self.version != self.client.pdata_version:
+                self.version = self.client.pdata_version
+                self.generator = VoucherGenerator(self.client)
+                # thread pools of concurrent calls share the generators, so every pool has its own key
+                key = next(pool_keys)
+                self.keys.append(key)
+                self.func = functools.partial(generate_voucher, key)
+                if self.processes and metrics.enabled:
+                    # worker processes send the values they recorded back with the vouchers
+                    self.func = metrics.Collect(self.func)
+                if self.pool is not None:
+                    # other threads may still hand batches to the old pool
+                    self.retired.append(self.pool)
+                    self.pool = None
+                if self.workers > 0:
+                    pool_type = multiprocessing.Pool if self.processes else multiprocessing.pool.ThreadPool
+                    self.pool = pool_type(self.workers, initializer=init_generator, initargs=(key, self.generator))
+            return self.generator, self.pool, self.func
+
+    def close(self):
+        """Waits for all pools to finish and stops them"""
+        pools = self.retired + ([self.pool] if self.pool is not None else [])
+        for pool in pools:
+            pool.close()
+            pool.join()
+        for key in self.keys:
+            generators.pop(key, None)
+        self.pool = None
+        self.retired = list()
 
 
 class Client:
     """Represents a client in the tPSI-AD protocol"""
+    pool = None  # optional RandomnessPool, never pickled
+    pdata_version = 0
+
     def __init__(self, id, server):
         self.id = id
         self.server = server
@@ -36,59 +282,117 @@ class Client:
         self.shamir_secret = util.init_sh_poly(self.adkey, server.t)
         self.pdata = self.server.pdata
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('pool', None)
+        return state
+
+    def keys(self):
+        """Returns the ID and the secrets of the client"""
+        return self.id, self.adkey, self.fkey, self.shamir_secret
+
+    @staticmethod
+    def restore(server, keys):
+        """Restores a client from its ID and secrets, its triples are not kept"""
+        client = Client.__new__(Client)
+        client.id, client.adkey, client.fkey, client.shamir_secret = keys
+        client.server = server
+        client.triples = list()
+        client.pdata = server.pdata
+        return client
+
+    def start_pool(self, size=256, watermark=64, background=True):
+        """Precomputes voucher randomness, in the background or in bulk right away if background is False"""
+        self.pool = RandomnessPool(self.pdata[0], size, watermark, background)
+        if background:
+            self.pool.start()
+        else:
+            self.pool.fill()
+        return self.pool
+
+    def apply_pdata_delta(self, delta):
+        """Applies the changed pdata entries the server sent after its malicious set changed"""
+        if delta.full:
+            self.pdata = [P for _, P in delta.entries]
+        else:
+            if not isinstance(self.pdata, list):
+                # a mapped pdata is read-only
+                self.pdata = list(self.pdata)
+            for i, P in delta.entries:
+                self.pdata[i] = P
+        self.pdata_version = delta.version
+
     def add_triple(self, y, id, ad):
         """Adds a triple and sends an according voucher"""
         triple = Triple(y, id, ad)
         self.triples.append(triple)
-        print(f"triple {triple.id} was added for client {self.id}")
+        util.log(f"triple {triple.id} was added for client {self.id}")
         self.send_voucher(triple)
 
+    def add_triple_file(self, y, id, path):
+        """Adds a triple whose image is streamed from a file and sends an according voucher"""
+        self.add_triple(y, id, path)
+
+    def add_triples(self, triples, workers=1, batch_size=256, processes=True):
+        """Adds many (y, id, ad) triples and sends their vouchers to the server in batches
+
+        With workers > 1 the vouchers are generated in a pool of worker processes, or threads if processes is
+        False, while the previous batch is sent. ADs given as file paths are streamed by the calling thread.
+        Returns the number of added triples."""
+        gens = GeneratorPool(self, workers if workers > 1 else 0, processes)
+        cnt = 0
+        sending = None
+        try:
+            for batch in util.chunked(triples, batch_size):
+                # sending the previous batch may have brought new pdata
+                gen, pool, func = gens.current()
+                batch = [t if isinstance(t, Triple) else Triple(*t) for t in batch]
+                args = [(t, self.pool.take() if self.pool is not None else None) for t in batch]
+                if pool is not None:
+                    vouchers = pool.starmap_async(func, args, max(1, len(args) // (workers * 4)))
+                else:
+                    vouchers = [gen.generate(*a) for a in args]
+                if sending is not None:
+                    self.send_vouchers(*sending)
+                sending = (batch, vouchers)
+                cnt += len(batch)
+            if sending is not None:
+                self.send_vouchers(*sending)
+        finally:
+            gens.close()
+        util.log(f"{cnt} triples were added for client {self.id}", util.INFO)
+        return cnt
+
+    def stream_ad(self, path, id):
+        """Encrypts the image of the triple with the given ID chunk by chunk from disk into the server's AD
+        segment, returns its adref"""
+        with open(path, 'rb') as f:
+            length = util.stream_length(os.fstat(f.fileno()).st_size)
+            return self.server.receive_ad(util.aes128_enc_stream(self.adkey, f, id), length)
+
     def send_voucher(self, triple):
         """Sends a voucher to the server"""
         voucher = self.generate_voucher(triple)
         self.server.receive_voucher(self, voucher)
 
+    def send_vouchers(self, triples, vouchers):
+        """Streams the file ADs of a batch of triples and sends their vouchers, which may still be generated
+        by a worker pool"""
+        if not isinstance(vouchers, list):
+            vouchers = vouchers.get()
+            if len(vouchers) > 0 and isinstance(vouchers[0], tuple):
+                # results of metrics.Collect
+                vouchers = list(metrics.merged(vouchers))
+        for triple, voucher in zip(triples, vouchers):
+            if isinstance(triple.ad, str):
+                voucher.adref = self.stream_ad(triple.ad, triple.id)
+        self.triples.extend(triples)
+        self.server.receive_vouchers(self, vouchers)
+
     def generate_voucher(self, triple):
         """Generates a voucher for a triple according to tPSI-AD protocol"""
-        # step 1
-        adct = util.aes128_enc(self.adkey, triple.ad)
-        # step 2
-        prf_sh_x, prf_sh_z, prf_x, prf_r = util.calc_prf(self.fkey, triple.id)
-        # step 3
-        sh_z = util.calc_poly(prf_sh_x, self.shamir_secret)
-        # step 4
-        rkey = get_random_bytes(16)
-        json_k = ['x', 'z']
-        json_v = [prf_sh_x, sh_z]
-        sh = json.dumps(dict(zip(json_k, json_v)))
-        json_k = ['adct', 'sh']
-        json_v = [adct, sh]
-        rct_data = json.dumps(dict(zip(json_k, json_v))).encode()
-        rct = util.aes128_enc(rkey, rct_data)
-        # step 5.1
-        w1, w2 = util.calc_h(triple.y, self.server.n_dash, self.server.h1_index, self.server.h2_index)
-        # step 5.2
-        L = ECC.EccPoint(x=self.pdata[0][0], y=self.pdata[0][1], curve='p256')
-        beta1 = random.randint(0, util.ecc_q)
-        gamma1 = random.randint(0, util.ecc_q)
-        beta2 = random.randint(0, util.ecc_q)
-        gamma2 = random.randint(0, util.ecc_q)
-        Q1 = beta1 * util.calc_H(triple.y) + gamma1 * util.ecc_gen
-        Q2 = beta2 * util.calc_H(triple.y) + gamma2 * util.ecc_gen
-        Q1_tuple = (int(Q1.x), int(Q1.y))
-        Q2_tuple = (int(Q2.x), int(Q2.y))
-        P_w1 = ECC.EccPoint(x=self.pdata[w1 + 1][0], y=self.pdata[w1 + 1][1], curve='p256')
-        P_w2 = ECC.EccPoint(x=self.pdata[w2 + 1][0], y=self.pdata[w2 + 1][1], curve='p256')
-        S1 = beta1 * P_w1 + gamma1 * L
-        S2 = beta2 * P_w2 + gamma2 * L
-        # step 5.3
-        H_dash_S1 = util.calc_H_dash(S1)
-        H_dash_S2 = util.calc_H_dash(S2)
-        ct1 = util.aes128_enc(H_dash_S1, rkey)
-        ct2 = util.aes128_enc(H_dash_S2, rkey)
-        # step 6
-        if random.randint(1, 2) == 1:
-            voucher = Voucher(triple.id, Q1_tuple, ct1, Q2_tuple, ct2, rct)
-        else:
-            voucher = Voucher(triple.id, Q2_tuple, ct2, Q1_tuple, ct1, rct)
+        voucher = VoucherGenerator(self).generate(triple, self.pool.take() if self.pool is not None else None)
+        if isinstance(triple.ad, str):
+            # the image is encrypted chunk by chunk from disk into the server's AD segment
+            voucher.adref = self.stream_ad(triple.ad, triple.id)
         return voucher
@@ -0,0 +1,153 @@
+import numpy as np
+
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import breadth_first_order, connected_components
+
+import metrics
+
+
+class CuckooTable:
+    """Cuckoo table over two candidate slots per entry, with a bounded stash for failed inserts"""
+    def __init__(self, size, h1, h2, max_evictions=100, stash_size=64):
+        self.size = size
+        self.h1 = np.asarray(h1, dtype=np.int64)  # first candidate slot of every entry
+        self.h2 = np.asarray(h2, dtype=np.int64)  # second candidate slot of every entry
+        self.slots = np.full(size, -1, dtype=np.int64)  # entry index per slot, -1 if free
+        self.max_evictions = max_evictions  # evictions per insert before giving up
+        self.stash_size = stash_size
+        self.stash = list()  # entries that did not fit into the table, they are missing in pdata
+        self.discarded = list()  # entries that did not fit into the stash either
+        self.evictions = 0
+        self.longest_chain = 0
+
+    def build(self):
+        """Places all entries at once, as many as the candidate slots allow
+
+        Every entry is an edge between its two candidate slots. A connected component can hold as many
+        entries as it has slots: all edges of a BFS spanning tree, each stored in the slot of its child,
+        plus one more edge for the root. All other entries go to the stash."""
+        n = self.size
+        e = np.flatnonzero(self.h1 != self.h2)
+        a = self.h1[e]
+        b = self.h2[e]
+        # BFS from a virtual slot n that is connected to the first slot of every component
+        graph = coo_matrix((np.ones(len(e)), (a, b)), shape=(n, n)).tocsr()
+        n_comp, labels = connected_components(graph, directed=False)
+        roots = np.unique(labels, return_index=True)[1]
+        rows = np.concatenate([a, np.full(len(roots), n)])
+        cols = np.concatenate([b, roots])
+        graph = coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n + 1, n + 1)).tocsr()
+        pred = breadth_first_order(graph, n, directed=False, return_predecessors=True)[1]
+
+        # every slot except the roots takes an entry connecting it to its parent
+        keys = np.minimum(a, b) * n + np.maximum(a, b)
+        order = np.argsort(keys, kind='stable')
+        children = np.flatnonzero((pred[:n] >= 0) & (pred[:n] != n))
+        parents = pred[children]
+        tree = order[np.searchsorted(keys[order], np.minimum(parents, children) * n + np.maximum(parents, children))]
+        self.slots[children] = e[tree]
+
+        # every component with an entry left over also fills its root, by shifting the entries on the
+        # path from one end of that entry up to the root by one slot
+        rest = np.ones(len(e), dtype=bool)
+        rest[tree] = False
+        rest = np.flatnonzero(rest)
+        extra = rest[np.unique(labels[a[rest]], return_index=True)[1]]
+        slots = self.slots.copy()
+        cur = a[extra]
+        while len(cur) > 0:
+            par = pred[cur]
+            cur = cur[par != n]
+            par = par[par != n]
+            self.slots[par] = slots[cur]
+            cur = par
+        self.slots[a[extra]] = e[extra]
+
+        rest = e[np.setdiff1d(rest, extra)].tolist()
+        room = max(0, self.stash_size - len(self.stash))
+        self.stash.extend(rest[:room])
+        self.discarded.extend(rest[room:])
+        # entries with a single candidate slot
+        for i in np.flatnonzero(self.h1 == self.h2).tolist():
+            self.insert(i)
+        return self
+
+    def put_aside(self, i):
+        """Puts an entry that did not fit into the table into the stash, or discards it if the stash is full"""
+        if len(self.stash) < self.stash_size:
+            self.stash.append(i)
+        else:
+            self.discarded.append(i)
+
+    def insert(self, i):
+        """Inserts entry i, moving evicted entries to their other slot, returns the changed slots"""
+        slots = self.slots
+        changed = list()
+        pos = int(self.h1[i])
+        if slots[pos] >= 0 and slots[self.h2[i]] < 0:
+            pos = int(self.h2[i])
+        for chain in range(self.max_evictions + 1):
+            evicted = int(slots[pos])
+            slots[pos] = i
+            changed.append(pos)
+            if evicted < 0:
+                self.longest_chain = max(self.longest_chain, chain)
+                if metrics.enabled and chain > 0:
+                    metrics.inc("cuckoo_evictions_total", chain)
+                return changed
+            self.evictions += 1
+            if chain == self.max_evictions:
+                break
+            i = evicted
+            h1 = int(self.h1[i])
+            pos = int(self.h2[i]) if h1 == pos else h1
+        # the last evicted entry is left without a slot
+        self.longest_chain = self.max_evictions
+        if metrics.enabled:
+            metrics.inc("cuckoo_evictions_total", self.max_evictions + 1)
+            metrics.inc("cuckoo_failed_inserts_total")
+        self.put_aside(evicted)
+        return changed
+
+    def add(self, h1, h2):
+        """Adds a new entry with the given candidate slots and inserts it, returns the changed slots"""
+        self.h1 = np.append(self.h1, h1)
+        self.h2 = np.append(self.h2, h2)
+        return self.insert(len(self.h1) - 1)
+
+    def position(self, i):
+        """Returns the slot holding entry i, -1 if it is not in the table"""
+        for pos in (int(self.h1[i]), int(self.h2[i])):
+            if self.slots[pos] == i:
+                return pos
+        return -1
+
+    def remove(self, i):
+        """Removes entry i and moves a stashed entry into the freed slot if one fits, returns the changed slots"""
+        pos = self.position(i)
+        if pos < 0:
+            if i in self.stash:
+                self.stash.remove(i)
+            elif i in self.discarded:
+                self.discarded.remove(i)
+            return list()
+        self.slots[pos] = -1
+        for j in self.stash:
+            if self.h1[j] == pos or self.h2[j] == pos:
+                self.stash.remove(j)
+                self.slots[pos] = j
+                break
+        return [pos]
+
+    def stats(self):
+        """Returns load factor and eviction statistics of the table"""
+        placed = int(np.count_nonzero(self.slots >= 0))
+        return {
+            'size': self.size,
+            'placed': placed,
+            'load_factor': placed / self.size if self.size > 0 else 0.0,
+            'evictions': self.evictions,
+            'longest_chain': self.longest_chain,
+            'stashed': len(self.stash),
+            'discarded': len(self.discarded),
+        }
@@ -0,0 +1,177 @@
+import functools
+
+import metrics
+
+from Crypto.PublicKey import ECC
+
+# NIST P-256 domain parameters, points are affine (x, y) tuples and None is the point at infinity
+p = 115792089210356248762697446949407573530086143415290314195533631308867097853951
+q = 115792089210356248762697446949407573529996955224135760342422259061068512044369
+b = 0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b
+G = (0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296,
+     0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5)
+
+
+def is_on_curve(P):
+    """Checks if an affine point satisfies y^2 = x^3 - 3x + b"""
+    x, y = P
+    return (y * y - x * x * x + 3 * x - b) % p == 0
+
+
+def jacobian_double(X, Y, Z):
+    """Doubles a point in Jacobian coordinates (dbl-2001-b for a = -3)"""
+    if Z == 0 or Y == 0:
+        return 1, 1, 0
+    delta = Z * Z % p
+    gamma = Y * Y % p
+    beta = X * gamma % p
+    alpha = 3 * (X - delta) * (X + delta) % p
+    X3 = (alpha * alpha - 8 * beta) % p
+    Z3 = ((Y + Z) * (Y + Z) - gamma - delta) % p
+    Y3 = (alpha * (4 * beta - X3) - 8 * gamma * gamma) % p
+    return X3, Y3, Z3
+
+
+def jacobian_add_affine(X1, Y1, Z1, x2, y2):
+    """Adds an affine point to a point in Jacobian coordinates (madd-2007-bl)"""
+    if Z1 == 0:
+        return x2, y2, 1
+    Z1Z1 = Z1 * Z1 % p
+    U2 = x2 * Z1Z1 % p
+    S2 = y2 * Z1 * Z1Z1 % p
+    H = (U2 - X1) % p
+    r = (S2 - Y1) % p
+    if H == 0:
+        if r == 0:
+            return jacobian_double(X1, Y1, Z1)
+        return 1, 1, 0
+    HH = H * H % p
+    HHH = H * HH % p
+    V = X1 * HH % p
+    X3 = (r * r - HHH - 2 * V) % p
+    Y3 = (r * (V - X3) - Y1 * HHH) % p
+    Z3 = Z1 * H % p
+    return X3, Y3, Z3
+
+
+def to_affine(X, Y, Z):
+    """Converts a point in Jacobian coordinates to an affine point"""
+    if Z == 0:
+        return None
+    z_inv = pow(Z, -1, p)
+    z_inv2 = z_inv * z_inv % p
+    return X * z_inv2 % p, Y * z_inv2 * z_inv % p
+
+
+def batch_to_affine(points):
+    """Converts a list of points in Jacobian coordinates to affine points using a single inversion"""
+    prefix = list()
+    acc = 1
+    for X, Y, Z in points:
+        prefix.append(acc)
+        if Z != 0:
+            acc = acc * Z % p
+    inv = pow(acc, -1, p)
+    res = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        if Z == 0:
+            continue
+        z_inv = inv * prefix[i] % p
+        inv = inv * Z % p
+        z_inv2 = z_inv * z_inv % p
+        res[i] = (X * z_inv2 % p, Y * z_inv2 * z_inv % p)
+    return res
+
+
+def add(P1, P2):
+    """Adds two affine points"""
+    if P1 is None:
+        return P2
+    if P2 is None:
+        return P1
+    return to_affine(*jacobian_add_affine(P1[0], P1[1], 1, P2[0], P2[1]))
+
+
+def mul(k, P):
+    """Multiplies an arbitrary affine point with a scalar"""
+    k %= q
+    if P is None or k == 0:
+        return None
+    if metrics.enabled:
+        metrics.inc("ec_scalar_mul_total", kind="variable")
+    # a single variable-base multiplication is fastest in pycryptodome's native code
+    point = ECC.EccPoint(x=P[0], y=P[1], curve='p256')
+    point *= k
+    # is_point_at_infinity() would encode the point a second time
+    x, y = point.xy
+    if x == 0 and y == 0:
+        return None
+    return int(x), int(y)
+
+
+class FixedBase:
+    """Comb table for a fixed point P, row j holds d * 2^(w*j) * P for all w-bit digits d"""
+    def __init__(self, P, w=8):
+        self.P = P
+        self.w = w
+        self.size = 1 << w
+        self.rows = (q.bit_length() + w - 1) // w
+        table = list()
+        base = P
+        for j in range(self.rows):
+            row = [(1, 1, 0)]
+            for d in range(1, self.size):
+                row.append(jacobian_add_affine(*row[-1], *base))
+            table.extend(batch_to_affine(row))
+            base = to_affine(*jacobian_double(*row[self.size >> 1]))
+        self.table = table
+
+    def mul(self, k):
+        """Multiplies P with a scalar, one mixed addition per non-zero digit and no doublings"""
+        return to_affine(*self.mul_add(k, 1, 1, 0))
+
+    def mul_add(self, k, X, Y, Z):
+        """Adds k * P to a point in Jacobian coordinates"""
+        if metrics.enabled:
+            metrics.inc("ec_scalar_mul_total", kind="fixed")
+        k %= q
+        table = self.table
+        w = self.w
+        mask = self.size - 1
+        off = 0
+        while k:
+            d = k & mask
+            if d:
+                x2, y2 = table[off + d]
+                if Z == 0:
+                    X, Y, Z = x2, y2, 1
+                else:
+                    # inlined jacobian_add_affine
+                    Z1Z1 = Z * Z % p
+                    H = (x2 * Z1Z1 - X) % p
+                    r = (y2 * Z * Z1Z1 - Y) % p
+                    if H == 0:
+                        X, Y, Z = jacobian_add_affine(X, Y, Z, x2, y2)
+                    else:
+                        HH = H * H % p
+                        HHH = H * HH % p
+                        V = X * HH % p
+                        X = (r * r - HHH - 2 * V) % p
+                        Y = (r * (V - X) - Y * HHH) % p
+                        Z = Z * H % p
+            k >>= w
+            off += mask + 1
+        return X, Y, Z
+
+
+@functools.lru_cache(maxsize=16)
+def fixed_base(P):
+    """Returns the comb table for a fixed point, built once per process"""
+    return FixedBase(P)
+
+
+def mul_base(k):
+    """Multiplies the generator with a scalar"""
+    return fixed_base(G).mul(k)
+
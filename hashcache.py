@@ -0,0 +1,76 @@
+import hashlib
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+
+def file_digest(path):
+    """Calculates the sha256 digest of the contents of a file"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.digest()
+
+
+def fingerprint(*paths):
+    """Calculates a fingerprint over the contents of several files, e.g. the model and the seed matrix"""
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(file_digest(path))
+    return h.digest()
+
+
+class HashCache:
+    """Content-addressed NeuralHash cache, an SQLite store with an LRU-bounded in-memory layer in front"""
+    def __init__(self, path, fp, capacity=100000):
+        self.fp = fp  # fingerprint of model and seed matrix
+        self.capacity = capacity  # maximum number of entries kept in memory
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS nnhash (digest BLOB, fp BLOB, hash BLOB, "
+                        "PRIMARY KEY (digest, fp)) WITHOUT ROWID")
+        self.db.commit()
+
+    def remember(self, digest, h):
+        """Puts a hash into the in-memory layer and evicts the least recently used entries"""
+        self.lru[digest] = h
+        self.lru.move_to_end(digest)
+        while len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    def get_many(self, digests):
+        """Returns the hex hashes for the given content digests, None for every miss"""
+        res = list()
+        with self.lock:
+            for d in digests:
+                h = self.lru.get(d)
+                if h is None:
+                    row = self.db.execute("SELECT hash FROM nnhash WHERE digest = ? AND fp = ?",
+                                          (d, self.fp)).fetchone()
+                    if row is not None:
+                        h = row[0].hex()
+                if h is not None:
+                    self.remember(d, h)
+                res.append(h)
+        return res
+
+    def put_many(self, digests, hashes):
+        """Stores the hex hashes for the given content digests in one transaction"""
+        with self.lock:
+            rows = [(d, self.fp, bytes.fromhex(h)) for d, h in zip(digests, hashes)]
+            self.db.executemany("INSERT OR REPLACE INTO nnhash VALUES (?, ?, ?)", rows)
+            self.db.commit()
+            for d, h in zip(digests, hashes):
+                self.remember(d, h)
+
+    def get(self, digest):
+        """Returns the hex hash for a content digest or None"""
+        return self.get_many([digest])[0]
+
+    def put(self, digest, h):
+        """Stores the hex hash for a content digest"""
+        self.put_many([digest], [h])
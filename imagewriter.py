@@ -0,0 +1,121 @@
+import os
+import queue
+import threading
+import time
+
+import metrics
+import util
+
+STOP = object()  # ends a writer thread
+
+
+class ImageWriter:
+    """Write-behind output of decrypted images: save requests go into a bounded queue drained by writer
+    threads, so processing goes on while images are written and only blocks if the writers fall behind.
+    Streamed ADs are decrypted from the AD segment by the writer threads as well.
+    Every image is written to a temporary file and renamed, a crash never leaves a partial image."""
+    def __init__(self, workers=2, queue_size=256, sync=True):
+        self.workers = workers
+        self.sync = sync  # fsync every image before renaming it, off the processing thread this is cheap
+        self.queue = queue.Queue(queue_size)
+        self.threads = list()
+        self.lock = threading.Lock()
+        self.dirs = set()  # output directories known to exist
+        self.errors = list()  # (directory, id, error) of failed writes since the last flush, ValueError for ADs
+        # that are not authentic
+        self.written = 0
+
+    def start(self):
+        """Starts the writer threads, called by the first save"""
+        self.threads = [threading.Thread(target=self.work, name=f"image-writer-{i}", daemon=True)
+                        for i in range(self.workers)]
+        for t in self.threads:
+            t.start()
+
+    def save(self, path, id, data):
+        """Queues an image for writing to <path><id>.png, blocks while the queue is full"""
+        if len(self.threads) == 0:
+            with self.lock:
+                if len(self.threads) == 0:
+                    self.start()
+        self.queue.put((path, id, data))
+
+    def save_stream(self, path, id, key, segment_path, adref):
+        """Queues a streamed AD for decryption from the AD segment to <path><id>.png"""
+        self.save(path, id, (key, segment_path, adref))
+
+    def make_dir(self, path):
+        """Creates an output directory once"""
+        if path in self.dirs:
+            return
+        with self.lock:
+            if path not in self.dirs:
+                if not os.path.exists(path):
+                    os.makedirs(path, 0o777, exist_ok=True)
+                    util.log(f"Created Dir: {path}", util.INFO)
+                self.dirs.add(path)
+
+    def write(self, path, id, data):
+        """Writes one image, the directory is created again if it was removed in the meantime"""
+        start = time.perf_counter()
+        self.make_dir(path)
+        try:
+            self.write_file(path, id, data)
+        except FileNotFoundError:
+            self.forget(path)
+            self.make_dir(path)
+            self.write_file(path, id, data)
+        if metrics.enabled:
+            metrics.observe("image_write_seconds", time.perf_counter() - start)
+            metrics.inc("images_written_total")
+
+    def write_file(self, path, id, data):
+        """Writes the image file, data is the image or (key, segment path, adref) of a streamed AD, raises
+        ValueError if a streamed AD is not authentic"""
+        if isinstance(data, tuple):
+            if util.save_image_stream(*data, id, path, self.sync) is None:
+                raise ValueError("streamed AD is not authentic")
+        else:
+            util.save_image((id, data), path, self.sync)
+
+    def work(self):
+        """Writes queued images until stopped"""
+        while True:
+            item = self.queue.get()
+            try:
+                if item is STOP:
+                    return
+                try:
+                    self.write(*item)
+                    with self.lock:
+                        self.written += 1
+                except Exception as exe:
+                    # a failed write must not end the thread, flush would wait forever
+                    util.log(f"could not write image {item[1]} to {item[0]} because of {exe}", util.INFO)
+                    with self.lock:
+                        self.errors.append((item[0], item[1], exe))
+            finally:
+                self.queue.task_done()
+
+    def forget(self, path):
+        """Drops a removed directory from the cache, after a flush so that no write recreates it"""
+        with self.lock:
+            self.dirs.discard(path)
+
+    def flush(self):
+        """Waits until all queued images are written, returns the failed writes since the last flush"""
+        self.queue.join()
+        with self.lock:
+            errors = self.errors
+            self.errors = list()
+        return errors
+
+    def close(self):
+        """Writes all queued images and stops the writer threads"""
+        errors = self.flush()
+        for _ in self.threads:
+            self.queue.put(STOP)
+        for t in self.threads:
+            t.join()
+        self.threads = list()
+        return errors
@@ -0,0 +1,194 @@
+"""End-to-end load test: concurrent synthetic clients upload triples while the server processes vouchers in
+between, reports latency percentiles, throughput, peak RSS and the time until flagged clients are decrypted"""
+import argparse
+import json
+import metrics
+import platform
+import shutil
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import synthetic
+import util
+
+from client import Triple
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes, None if it is unknown"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def percentiles(samples):
+    """Returns p50, p95 and p99 of samples in seconds as milliseconds"""
+    if len(samples) == 0:
+        return None
+    p50, p95, p99 = np.percentile(np.array(samples) * 1e3, [50, 95, 99])
+    return {'p50': p50, 'p95': p95, 'p99': p99}
+
+
+class LoadTest:
+    """Clients upload their triples in worker threads and hand every batch to the server under a lock, a
+    processing thread runs process_vouchers every interval seconds under the same lock"""
+    def __init__(self, x=10 ** 3, clients=20, triples=20, match_fraction=0.15, t=3, workers=4, batch_size=1,
+                 interval=1.0):
+        self.server = synthetic.server(x, t, "Load")
+        self.clients = synthetic.clients(self.server, clients)
+        self.workers = workers
+        self.batch_size = batch_size  # vouchers per receive_vouchers call
+        self.interval = interval  # seconds between processing runs
+        # the triples are drawn up front, so that their generation is not part of the measurement
+        self.triples = {c.id: [Triple(*tr) for tr in synthetic.triples(self.server, triples, match_fraction)]
+                        for c in self.clients}
+        matching = set(synthetic.matching(self.server))
+        self.matches = {c: sum(tr.y in matching for tr in ts) for c, ts in self.triples.items()}
+        self.lock = threading.Lock()
+        self.gen_latency = list()
+        self.ingest_latency = list()
+        self.first_sent = dict()  # client ID -> time of its first voucher
+        self.first_output = dict()  # client ID -> time of its first decrypted AD
+        self.processed = 0
+        self.process_time = 0.0
+        self.runs = 0
+        self.done = threading.Event()
+
+    def upload(self, client):
+        """Generates and sends the vouchers of one client"""
+        batch = list()
+        for triple in self.triples[client.id]:
+            start = time.perf_counter()
+            batch.append(client.generate_voucher(triple))
+            self.gen_latency.append(time.perf_counter() - start)
+            if len(batch) >= self.batch_size:
+                self.send(client, batch)
+                batch = list()
+        if len(batch) > 0:
+            self.send(client, batch)
+
+    def send(self, client, batch):
+        """Hands a batch to the server, the latency includes waiting for a processing run"""
+        start = time.perf_counter()
+        with self.lock:
+            self.first_sent.setdefault(client.id, start)
+            self.server.receive_vouchers(client, batch)
+        self.ingest_latency.append(time.perf_counter() - start)
+
+    def process(self):
+        """Runs process_vouchers once and records which clients got decrypted ADs"""
+        with self.lock:
+            ids = self.server.client_id_list
+            start = time.perf_counter()
+            IDLIST, OUTSET = self.server.process_vouchers()
+            end = time.perf_counter()
+        self.runs += 1
+        self.process_time += end - start
+        self.processed += sum(len(i) for i in IDLIST)
+        for client_id, out in zip(ids, OUTSET):
+            if len(out) > 0 and isinstance(out[0], tuple):
+                self.first_output.setdefault(client_id, end)
+
+    def processor(self):
+        """Processes the received vouchers every interval seconds until all clients are done"""
+        while not self.done.wait(self.interval):
+            self.process()
+
+    def run(self):
+        """Runs the load test and returns the report"""
+        util.log_level = util.QUIET
+        processor = threading.Thread(target=self.processor, daemon=True)
+        start = time.perf_counter()
+        processor.start()
+        with ThreadPoolExecutor(self.workers) as pool:
+            list(pool.map(self.upload, self.clients))
+        self.done.set()
+        processor.join()
+        # the vouchers that arrived after the last run
+        self.process()
+        elapsed = time.perf_counter() - start
+        util.log_level = util.INFO
+        t = self.server.t
+        flagged = [c for c, m in self.matches.items() if m > t]
+        first = [self.first_output[c] - self.first_sent[c] for c in flagged if c in self.first_output]
+        vouchers = sum(len(ts) for ts in self.triples.values())
+        return {
+            'clients': len(self.clients),
+            'vouchers': vouchers,
+            'flagged_clients': len(flagged),
+            'decrypted_clients': len(self.first_output),
+            'elapsed_s': elapsed,
+            'processing_runs': self.runs,
+            'generation_ms': percentiles(self.gen_latency),
+            'ingest_ms': percentiles(self.ingest_latency),
+            'ingested_per_s': vouchers / elapsed,
+            'processed_per_s': self.processed / self.process_time if self.process_time > 0 else None,
+            'first_decrypt_ms': percentiles(first),
+            'peak_rss_bytes': peak_rss(),
+        }
+
+
+def print_report(r):
+    """Prints a report in readable form"""
+    print(f"{r['clients']} clients, {r['vouchers']} vouchers in {r['elapsed_s']:.1f}s, "
+          f"{r['processing_runs']} processing runs")
+    for key, name in (('generation_ms', "voucher generation"), ('ingest_ms', "ingest"),
+                      ('first_decrypt_ms', "first decrypted AD")):
+        p = r[key]
+        if p is not None:
+            print(f"{name:<20} p50 {p['p50']:>9.1f} ms  p95 {p['p95']:>9.1f} ms  p99 {p['p99']:>9.1f} ms")
+    print(f"ingested {r['ingested_per_s']:.1f} vouchers/s, processed "
+          f"{r['processed_per_s'] or 0:.1f} vouchers/s")
+    print(f"{r['decrypted_clients']} of {r['flagged_clients']} flagged clients were decrypted")
+    if r['peak_rss_bytes'] is not None:
+        print(f"peak RSS {r['peak_rss_bytes'] / 2 ** 20:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs an end-to-end load test on synthetic data")
+    parser.add_argument("--x", type=int, default=10 ** 3, help="size of the synthetic malicious set")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--triples", type=int, default=20, help="triples per client")
+    parser.add_argument("--match", type=float, default=0.15, help="fraction of triples matching X")
+    parser.add_argument("--t", type=int, default=3, help="threshold")
+    parser.add_argument("--workers", type=int, default=4, help="clients uploading at the same time")
+    parser.add_argument("--batch-size", type=int, default=1, help="vouchers per receive_vouchers call")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between processing runs")
+    parser.add_argument("--json", metavar="PATH", help="write the report as JSON")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="record metrics and write them to PATH, as Prometheus text for .prom, else as JSON")
+    args = parser.parse_args()
+    if args.metrics is not None:
+        metrics.enable()
+    root = synthetic.use_temp_root("tpsi-load-")
+    try:
+        test = LoadTest(args.x, args.clients, args.triples, args.match, args.t, args.workers, args.batch_size,
+                        args.interval)
+        r = test.run()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print_report(r)
+    if args.metrics is not None:
+        metrics.write(args.metrics)
+    if args.json is not None:
+        r['args'] = vars(args)
+        r['python'] = platform.python_version()
+        with open(args.json, 'w') as f:
+            json.dump(r, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
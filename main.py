@@ -1,4 +1,3 @@
-import pickle
 import shutil
 
 import nnhash
@@ -9,23 +8,7 @@ from shutil import copyfile
 import util
 from client import Client
 from server import Server
-
-
-def save_object(obj, path):
-    try:
-        with open(path, "wb") as f:
-            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
-            print(f"saved to {path}")
-    except Exception as e:
-        print("Error during pickling object:", e)
-
-
-def load_object(f_name):
-    try:
-        with open(f_name, "rb") as f:
-            return pickle.load(f)
-    except Exception as e:
-        print("Error during unpickling object:", e)
+from storage import Storage
 
 
 if not os.path.exists(util.root_dir):
@@ -36,11 +19,14 @@ if not os.path.exists(util.mal_img_dir):
     os.mkdir(util.mal_img_dir)
 if not os.path.exists(util.dec_img_dir):
     os.mkdir(util.dec_img_dir)
+# triples are uploaded one at a time, so every triple and voucher is shown
+util.log_level = util.DEBUG
 
-if os.path.isfile("server.pickle"):
-    server = load_object("server.pickle")
+storage = Storage(util.state_dir)
+if storage.exists():
+    server = storage.load()
 else:
-    server = Server("Apple")
+    server = storage.create(Server("Apple", voucher_path=storage.voucher_path))
     try:
         shutil.rmtree(util.clients_dir)
         os.mkdir(util.clients_dir, 0o777)
@@ -173,14 +159,11 @@ while True:
             dst_name = util.clients_dir + values["-CLIENT LIST-"][0] + "/" + values["-FILE LIST-"][0]
             copyfile(filename, dst_name)
             print(f"uploaded file from {filename} to {dst_name}")
-            with open(dst_name, "rb") as imageFile:
-                byte_arr = bytearray(imageFile.read())
             y = nnhash.calc_nnhash(dst_name)
             id = server.cur_id
-            ad = byte_arr
             server.inc_cur_id()
-            index = server.client_id_list.index(values["-CLIENT LIST-"][0])
-            server.client_list[index].add_triple(y, id, ad)
+            # the image is encrypted from disk in chunks instead of being read into memory
+            server.get_client(values["-CLIENT LIST-"][0]).add_triple_file(y, id, dst_name)
             server.inc_cur_id()
     elif event == "Process Vouchers":
         server.process_vouchers()
@@ -194,4 +177,5 @@ while True:
 
 window.close()
 
-save_object(server, "server.pickle")
+storage.checkpoint(server)
+storage.close()
@@ -0,0 +1,185 @@
+"""Counters and histograms of the hot paths of server and client, exported as JSON or Prometheus text
+
+Recording is off unless enabled is set (or TPSI_METRICS=1 in the environment), call sites check the flag
+before doing any work, so the disabled cost is one attribute lookup, or a call returning a shared no-op for
+phases."""
+import bisect
+import json
+import os
+import threading
+import time
+
+enabled = os.environ.get("TPSI_METRICS", "0") not in ("", "0")
+
+# upper bounds of the histogram buckets, seconds for timings and plain numbers for counts
+SECONDS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+COUNTS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+PREFIX = "tpsi_"
+
+counters = dict()  # (name, labels) -> value
+histograms = dict()  # (name, labels) -> [bucket bounds, bucket counts, sum, count]
+lock = threading.Lock()
+
+
+def enable(on=True):
+    """Switches recording on or off, recorded values are kept"""
+    global enabled
+    enabled = on
+
+
+def reset():
+    """Drops all recorded values"""
+    with lock:
+        counters.clear()
+        histograms.clear()
+
+
+def key(name, labels):
+    """Returns the key of a metric, labels are kept sorted by name"""
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+def inc(name, n=1, **labels):
+    """Adds n to a counter"""
+    k = key(name, labels)
+    with lock:
+        counters[k] = counters.get(k, 0) + n
+
+
+def observe(name, value, buckets=SECONDS, **labels):
+    """Records a value in a histogram, the buckets are fixed by the first observation"""
+    k = key(name, labels)
+    with lock:
+        h = histograms.get(k)
+        if h is None:
+            h = histograms[k] = [buckets, [0] * (len(buckets) + 1), 0, 0]
+        h[1][bisect.bisect_left(h[0], value)] += 1
+        h[2] += value
+        h[3] += 1
+
+
+class Phases:
+    """Times consecutive phases of one call, every mark records the seconds since the previous mark in
+    the histogram <name>_phase_seconds"""
+    def __init__(self, name):
+        self.name = name + "_phase_seconds"
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        observe(self.name, now - self.last, phase=phase)
+        self.last = now
+
+
+class NoPhases:
+    """Stand-in for Phases while recording is off"""
+    def mark(self, phase):
+        pass
+
+
+NO_PHASES = NoPhases()
+
+
+def phases(name):
+    """Returns a Phases timer, or a shared no-op if recording is off"""
+    return Phases(name) if enabled else NO_PHASES
+
+
+def raw():
+    """Returns a copy of all recorded values that can be passed to merge"""
+    with lock:
+        return dict(counters), {k: [h[0], list(h[1]), h[2], h[3]] for k, h in histograms.items()}
+
+
+def merge(data):
+    """Adds values returned by raw, e.g. of a worker process"""
+    cs, hs = data
+    with lock:
+        for k, v in cs.items():
+            counters[k] = counters.get(k, 0) + v
+        for k, (buckets, counts, total, count) in hs.items():
+            h = histograms.get(k)
+            if h is None:
+                histograms[k] = [buckets, list(counts), total, count]
+            else:
+                h[1] = [a + b for a, b in zip(h[1], counts)]
+                h[2] += total
+                h[3] += count
+
+
+class Collect:
+    """Wraps a function run by a worker process, so that it returns its result together with the values
+    recorded by that call, see merged"""
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        # workers of a forked pool start with a copy of the parent's values
+        enable()
+        reset()
+        result = self.func(*args)
+        return result, raw()
+
+
+def merged(results):
+    """Merges the values of results of a Collect function and yields the results themselves"""
+    for result, data in results:
+        merge(data)
+        yield result
+
+
+def label_text(labels, extra=()):
+    """Formats labels as in the Prometheus text format"""
+    items = list(labels) + list(extra)
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def snapshot():
+    """Returns all recorded values as a JSON-serialisable dict, histogram buckets are not cumulative"""
+    cs, hs = raw()
+    res = {'counters': dict(), 'histograms': dict()}
+    for (name, labels), v in sorted(cs.items()):
+        res['counters'][name + label_text(labels)] = v
+    for (name, labels), (buckets, counts, total, count) in sorted(hs.items()):
+        res['histograms'][name + label_text(labels)] = {
+            'buckets': {str(b): c for b, c in zip(list(buckets) + ["+Inf"], counts)},
+            'sum': total,
+            'count': count,
+        }
+    return res
+
+
+def prometheus():
+    """Returns all recorded values in the Prometheus text format"""
+    cs, hs = raw()
+    lines = list()
+    typed = set()
+    for (name, labels), v in sorted(cs.items()):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+        lines.append(f"{PREFIX}{name}{label_text(labels)} {v}")
+    for (name, labels), (buckets, counts, total, count) in sorted(hs.items()):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+        cumulative = 0
+        for b, c in zip(list(buckets) + ["+Inf"], counts):
+            cumulative += c
+            lines.append(f"{PREFIX}{name}_bucket{label_text(labels, [('le', b)])} {cumulative}")
+        lines.append(f"{PREFIX}{name}_sum{label_text(labels)} {total}")
+        lines.append(f"{PREFIX}{name}_count{label_text(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def write(path):
+    """Writes a snapshot to a file, in the Prometheus text format for .prom and .txt files, else as JSON"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        if path.endswith((".prom", ".txt")):
+            f.write(prometheus())
+        else:
+            json.dump(snapshot(), f, indent=1)
+    os.replace(tmp, path)
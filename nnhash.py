@@ -12,34 +12,132 @@
 # or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import os
 import onnxruntime
 import numpy as np
+import hashcache
+import util
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
+model_path = 'model.onnx'
+seed_path = 'neuralhash_128x96_seed1.dat'
 
-def calc_nnhash(img_path):
-    # Load ONNX model
-    session = onnxruntime.InferenceSession('model.onnx')
-
-    # Load output hash matrix
-    seed1 = open('neuralhash_128x96_seed1.dat', 'rb').read()[128:]
-    seed1 = np.frombuffer(seed1, dtype=np.float32)
-    seed1 = seed1.reshape([96, 128])
 
-    # Preprocess image
-    image = Image.open(img_path).convert('RGB')
+def preprocess(img):
+    """Loads an image (path or PIL image) and converts it to a [3, 360, 360] model input"""
+    image = img if isinstance(img, Image.Image) else Image.open(img)
+    image = image.convert('RGB')
     image = image.resize([360, 360])
-    arr = np.array(image).astype(np.float32) / 255.0
+    arr = np.asarray(image, dtype=np.float32) / 255.0
     arr = arr * 2.0 - 1.0
-    arr = arr.transpose(2, 0, 1).reshape([1, 3, 360, 360])
+    return arr.transpose(2, 0, 1)
+
+
+def preprocess_batch(paths_or_arrays):
+    """Stacks image paths or preprocessed [3, 360, 360] arrays into one [N, 3, 360, 360] tensor"""
+    arr = [i if isinstance(i, np.ndarray) else preprocess(i) for i in paths_or_arrays]
+    return np.stack(arr).astype(np.float32, copy=False)
+
+
+class NeuralHash:
+    """Long-lived NeuralHash engine, loads the ONNX session and the seed matrix only once"""
+    def __init__(self, model=model_path, seed=seed_path, cache_path=None):
+        # Load ONNX model
+        self.session = onnxruntime.InferenceSession(model)
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # the exported model may have a fixed batch dimension of 1
+        self.batched = not isinstance(model_input.shape[0], int) or model_input.shape[0] != 1
+
+        # Load output hash matrix
+        with open(seed, 'rb') as f:
+            seed1 = f.read()[128:]
+        self.seed = np.frombuffer(seed1, dtype=np.float32).reshape([96, 128])
+
+        # Open hash cache, entries are only valid for this model and seed matrix
+        self.cache = None
+        if cache_path is not None:
+            self.cache = hashcache.HashCache(cache_path, hashcache.fingerprint(model, seed))
+
+    def run(self, arr):
+        """Runs the model on a [N, 3, 360, 360] tensor and returns the [N, 128] outputs"""
+        if self.batched:
+            outs = self.session.run(None, {self.input_name: arr})[0]
+        else:
+            outs = np.concatenate([self.session.run(None, {self.input_name: arr[i:i + 1]})[0]
+                                   for i in range(len(arr))])
+        return outs.reshape(len(arr), -1)
+
+    def to_hex(self, outs):
+        """Converts [N, 128] model outputs to N hex hashes"""
+        hash_output = outs.dot(self.seed.T)
+        hash_bytes = np.packbits(hash_output >= 0, axis=1)
+        return [h.tobytes().hex() for h in hash_bytes]
 
-    # Run model
-    inputs = {session.get_inputs()[0].name: arr}
-    outs = session.run(None, inputs)
+    def lookup(self, items):
+        """Looks up image paths in the hash cache, returns the hashes (None for misses), the misses and the digests"""
+        if self.cache is None:
+            return [None] * len(items), list(range(len(items))), None
+        digests = [hashcache.file_digest(i) if isinstance(i, (str, os.PathLike)) else None for i in items]
+        found = iter(self.cache.get_many([d for d in digests if d is not None]))
+        hashes = [next(found) if d is not None else None for d in digests]
+        misses = [i for i in range(len(items)) if hashes[i] is None]
+        return hashes, misses, digests
 
-    # Convert model output to hex hash
-    hash_output = seed1.dot(outs[0].flatten())
-    hash_bits = ''.join(['1' if it >= 0 else '0' for it in hash_output])
-    hash_hex = '{:0{}x}'.format(int(hash_bits, 2), len(hash_bits) // 4)
+    def store(self, hashes, misses, digests, miss_hashes):
+        """Fills in the hashes of the misses and adds them to the hash cache"""
+        for i, h in zip(misses, miss_hashes):
+            hashes[i] = h
+        if self.cache is not None:
+            cached = [i for i in misses if digests[i] is not None]
+            self.cache.put_many([digests[i] for i in cached], [hashes[i] for i in cached])
 
-    return hash_hex
+    def hash_batch(self, paths_or_arrays):
+        """Calculates the hex hashes of image paths or preprocessed [3, 360, 360] arrays with one session call"""
+        items = list(paths_or_arrays)
+        hashes, misses, digests = self.lookup(items)
+        if len(misses) > 0:
+            arr = preprocess_batch([items[i] for i in misses])
+            self.store(hashes, misses, digests, self.to_hex(self.run(arr)))
+        return hashes
+
+    def prefetch(self, decoder, batches):
+        """Looks up the next batch in the hash cache and starts decoding its misses"""
+        batch = next(batches, None)
+        if not batch:
+            return None
+        hashes, misses, digests = self.lookup(batch)
+        decoded = decoder.submit(preprocess_batch, [batch[i] for i in misses]) if len(misses) > 0 else None
+        return hashes, misses, digests, decoded
+
+    def hash_stream(self, batches):
+        """Yields the hex hashes for every batch, decoding the next batch while the current one runs"""
+        batches = iter(batches)
+        with ThreadPoolExecutor(1) as decoder:
+            pending = self.prefetch(decoder, batches)
+            while pending is not None:
+                hashes, misses, digests, decoded = pending
+                pending = self.prefetch(decoder, batches)
+                if decoded is not None:
+                    self.store(hashes, misses, digests, self.to_hex(self.run(decoded.result())))
+                yield hashes
+
+    def calc_nnhash(self, img_path):
+        """Calculates the hex hash of a single image"""
+        return self.hash_batch([img_path])[0]
+
+
+_hasher = None
+
+
+def get_hasher():
+    """Returns the shared NeuralHash engine of this process, creating it on first use"""
+    global _hasher
+    if _hasher is None:
+        _hasher = NeuralHash(cache_path=util.nnhash_cache_path)
+    return _hasher
+
+
+def calc_nnhash(img_path):
+    return get_hasher().calc_nnhash(img_path)
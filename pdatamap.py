@@ -0,0 +1,106 @@
+import hashlib
+import mmap
+import os
+import threading
+
+from collections import OrderedDict
+
+import wire
+
+# binary pdata: magic, the sha256 digest of the rest, then t, n_dash, h1_index, h2_index and version as in a
+# PARAMS frame, then the points
+MAGIC = b"PDAT\x02"
+DIGEST_LEN = 32
+
+
+def encode(server):
+    """Encodes the pdata of a server with its parameters as in a PARAMS frame"""
+    header = wire.PARAMS_HEADER.pack(server.t, server.n_dash, server.h1_index, server.h2_index,
+                                     server.pdata_version)
+    return header + b"".join(wire.encode_point(P) for P in server.pdata)
+
+
+def matches(path, params):
+    """Checks if a pdata file holds the given encoded parameters and pdata, by their digest, as the pdata
+    version alone is the same for different servers"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(len(MAGIC) + DIGEST_LEN)
+    except OSError:
+        return False
+    return head == MAGIC + hashlib.sha256(params).digest()
+
+
+def write(path, params):
+    """Writes encoded parameters and pdata to a pdata file, replacing it atomically so that processes which
+    still map the old file keep a consistent version"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(hashlib.sha256(params).digest())
+        f.write(params)
+    os.replace(tmp, path)
+
+
+class PdataMap:
+    """Read-only pdata in the binary format, memory-mapped from a file shared by all processes on a node or
+    held in a buffer, points are decoded on access and kept in an LRU cache of this process"""
+    def __init__(self, buf, path=None, capacity=1 << 16):
+        self.path = path  # the mapped file, a copy of the map is opened again from it when pickled
+        self.capacity = capacity  # maximum number of decoded points kept in memory
+        self.buf = buf
+        self.t, self.n_dash, self.h1_index, self.h2_index, self.version = wire.PARAMS_HEADER.unpack_from(buf)
+        self.size = (len(buf) - wire.PARAMS_HEADER.size) // wire.POINT_LEN
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path, capacity=1 << 16):
+        """Maps a pdata file"""
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if m[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a pdata file")
+        return cls(memoryview(m)[len(MAGIC) + DIGEST_LEN:], path, capacity)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['lru'] = OrderedDict()
+        state['lock'] = None
+        if self.path is not None:
+            state['buf'] = None
+        else:
+            state['buf'] = bytes(self.buf)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        if self.buf is None:
+            self.buf = PdataMap.open(self.path).buf
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError("pdata index out of range")
+        with self.lock:
+            # the point at infinity is None, so a miss is marked by self
+            P = self.lru.get(i, self)
+            if P is not self:
+                self.lru.move_to_end(i)
+                return P
+        off = wire.PARAMS_HEADER.size + i * wire.POINT_LEN
+        P = wire.decode_point(self.buf[off:off + wire.POINT_LEN])
+        with self.lock:
+            self.lru[i] = P
+            while len(self.lru) > self.capacity:
+                self.lru.popitem(last=False)
+        return P
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
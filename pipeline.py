@@ -0,0 +1,272 @@
+"""Headless ingestion of image directories for one client, without PySimpleGUI:
+
+    directory scan -> copy -> batched NeuralHash -> voucher generation -> server ingest
+
+Every stage runs in its own worker threads and passes its results through a bounded queue, so a slow stage
+holds back the stages before it instead of piling up images in memory."""
+import argparse
+import hashcache
+import metrics
+import os
+import pickle
+import queue
+import shutil
+import threading
+import time
+
+import nnhash
+import service
+import util
+
+from client import Client, GeneratorPool, Triple
+from server import Server, scan_images
+from storage import Storage
+
+DONE = object()  # end of the input of a stage
+
+
+class Stage:
+    """Worker threads that take batches from a bounded input queue and put the results of func into the
+    queue of the next stage, items that fail are reported and skipped"""
+    def __init__(self, name, func, workers=1, batch_size=1, queue_size=64):
+        self.name = name
+        self.func = func  # list of items -> list of results
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.next = None
+        self.running = 0
+        self.lock = threading.Lock()
+        self.count = 0  # items taken from the queue
+        self.failed = 0
+        self.busy = 0.0  # seconds spent in func, summed over all workers
+
+    def start(self):
+        """Starts the worker threads"""
+        self.running = self.workers
+        threads = [threading.Thread(target=self.work, name=f"{self.name}-{i}", daemon=True)
+                   for i in range(self.workers)]
+        for t in threads:
+            t.start()
+        return threads
+
+    def take(self):
+        """Takes up to batch_size items, returns them and whether the input is done"""
+        items = list()
+        while len(items) < self.batch_size:
+            item = self.queue.get()
+            if item is DONE:
+                # left in the queue for the other workers
+                self.queue.put(DONE)
+                return items, True
+            items.append(item)
+        return items, False
+
+    def work(self):
+        """Runs func on batches until the input is done, the last worker ends the input of the next stage"""
+        done = False
+        while not done:
+            items, done = self.take()
+            if len(items) == 0:
+                continue
+            start = time.perf_counter()
+            try:
+                results = self.func(items)
+            except Exception as exe:
+                results = list()
+                with self.lock:
+                    self.failed += len(items)
+                util.log(f"{self.name}: {len(items)} items failed because of {exe}", util.INFO)
+            with self.lock:
+                self.count += len(items)
+                self.busy += time.perf_counter() - start
+            if self.next is not None:
+                for r in results:
+                    self.next.queue.put(r)
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last and self.next is not None:
+            self.next.queue.put(DONE)
+
+
+class Pipeline:
+    """Ingests the images of one client, see the module docstring"""
+    def __init__(self, server, client, copy=True, copy_workers=4, hash_workers=1, hash_batch=16,
+                 voucher_workers=2, processes=0, ingest_batch=256, queue_size=64, report_every=1000):
+        self.server = server
+        self.client = client
+        self.copy = copy  # copy the images into the client directory like the GUI upload does
+        self.report_every = report_every
+        self.generators = GeneratorPool(client, processes)  # worker processes for the EC work of the vouchers
+        self.id_lock = threading.Lock()
+        self.ingested = 0
+        self.reported = 0
+        self.start_time = None
+        self.stages = [
+            Stage("copy", self.copy_images, copy_workers, 1, queue_size),
+            Stage("hash", self.hash_images, hash_workers, hash_batch, queue_size),
+            Stage("voucher", self.generate_vouchers, voucher_workers, 16, queue_size),
+            Stage("ingest", self.ingest, 1, ingest_batch, queue_size),
+        ]
+        for stage, nxt in zip(self.stages, self.stages[1:]):
+            stage.next = nxt
+
+    def copy_images(self, paths):
+        """Copies images into the client directory, returns their new paths. The names get a digest of the
+        contents, so that images with the same name from different directories do not overwrite each other"""
+        if not self.copy:
+            return paths
+        dst_dir = f"{util.clients_dir}{self.client.id}/"
+        os.makedirs(dst_dir, 0o777, exist_ok=True)
+        dst = list()
+        for path in paths:
+            stem, ext = os.path.splitext(os.path.basename(path))
+            dst_path = f"{dst_dir}{stem}-{hashcache.file_digest(path).hex()[:16]}{ext}"
+            if not os.path.exists(dst_path):
+                # same name means same contents, a copy of another worker is only replaced by an equal one
+                tmp = f"{dst_path}.{threading.get_ident()}.tmp"
+                shutil.copyfile(path, tmp)
+                os.replace(tmp, dst_path)
+            dst.append(dst_path)
+        return dst
+
+    def hash_images(self, paths):
+        """Hashes a batch of images with one session call, returns (y, path) pairs"""
+        return list(zip(nnhash.get_hasher().hash_batch(paths), paths))
+
+    def generate_vouchers(self, items):
+        """Generates the vouchers of (y, path) pairs and streams their images into the AD segment, returns
+        (triple, voucher) pairs"""
+        with self.id_lock:
+            triples = list()
+            for y, path in items:
+                triples.append(Triple(y, self.server.cur_id, path))
+                self.server.inc_cur_id()
+        pool = self.client.pool
+        args = [(t, pool.take() if pool is not None else None) for t in triples]
+        # rebuilt once the client got new pdata
+        generator, pool, func = self.generators.current()
+        if pool is not None and metrics.enabled:
+            vouchers = list(metrics.merged(pool.starmap(func, args)))
+        elif pool is not None:
+            vouchers = pool.starmap(func, args)
+        else:
+            vouchers = [generator.generate(*a) for a in args]
+        for triple, voucher in zip(triples, vouchers):
+            voucher.adref = self.client.stream_ad(triple.ad, triple.id)
+        return list(zip(triples, vouchers))
+
+    def ingest(self, items):
+        """Hands a batch of vouchers to the server"""
+        triples = [t for t, _ in items]
+        self.server.receive_vouchers(self.client, [v for _, v in items])
+        self.client.triples.extend(triples)
+        self.ingested += len(items)
+        if self.ingested - self.reported >= self.report_every:
+            self.reported = self.ingested
+            elapsed = time.perf_counter() - self.start_time
+            print(f"ingested {self.ingested} images ({self.ingested / elapsed:.1f} images/s)")
+        return list()
+
+    def run(self, paths):
+        """Feeds the image paths through all stages, returns the number of ingested images"""
+        self.start_time = time.perf_counter()
+        # created before the workers start, so that they share one session
+        nnhash.get_hasher()
+        # the first pool is started before the workers
+        self.generators.current()
+        try:
+            threads = [t for stage in self.stages for t in stage.start()]
+            first = self.stages[0].queue
+            for path in paths:
+                # blocks while the copy stage is behind
+                first.put(path)
+            first.put(DONE)
+            for t in threads:
+                t.join()
+        finally:
+            self.generators.close()
+        elapsed = time.perf_counter() - self.start_time
+        for stage in self.stages:
+            print(f"{stage.name:<8} {stage.workers} workers  {stage.count} items  {stage.failed} failed  "
+                  f"{stage.busy:.1f}s busy")
+        print(f"ingested {self.ingested} images in {elapsed:.1f}s")
+        return self.ingested
+
+
+def remote_client(remote, client_id):
+    """Returns the client for ingesting through a service.RemoteServer, its secrets are kept in the clients
+    directory so that later runs send shares of the same polynomial"""
+    path = os.path.join(util.clients_dir, f"{client_id}.keys")
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return Client.restore(remote, pickle.load(f))
+    client = Client(client_id, remote)
+    with open(path, 'wb') as f:
+        pickle.dump(client.keys(), f)
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingests the images of one client without the GUI")
+    parser.add_argument("sources", nargs="+", help="directories with the images of the client")
+    parser.add_argument("--client", required=True, help="ID of the client, added if it is not registered")
+    parser.add_argument("--no-copy", action="store_true", help="read the images in place")
+    parser.add_argument("--copy-workers", type=int, default=4)
+    parser.add_argument("--hash-workers", type=int, default=1)
+    parser.add_argument("--hash-batch", type=int, default=16)
+    parser.add_argument("--voucher-workers", type=int, default=2)
+    parser.add_argument("--processes", type=int, default=0, help="worker processes for the voucher EC work")
+    parser.add_argument("--ingest-batch", type=int, default=256)
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--connect", metavar="ADDRESS",
+                        help="send the vouchers to the ingestion service at HOST:PORT or a Unix socket path")
+    parser.add_argument("--process", action="store_true", help="process the vouchers afterwards")
+    parser.add_argument("--process-workers", type=int, default=1)
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="record metrics and write them to PATH, as Prometheus text for .prom, else as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every triple and voucher")
+    args = parser.parse_args()
+    util.log_level = util.DEBUG if args.verbose else util.INFO
+    if args.metrics is not None:
+        metrics.enable()
+
+    for d in (util.root_dir, util.clients_dir, util.mal_img_dir, util.dec_img_dir):
+        os.makedirs(d, exist_ok=True)
+    paths = (path for source in args.sources for path in scan_images(source))
+    options = dict(copy=not args.no_copy, copy_workers=args.copy_workers, hash_workers=args.hash_workers,
+                   hash_batch=args.hash_batch, voucher_workers=args.voucher_workers, processes=args.processes,
+                   ingest_batch=args.ingest_batch, queue_size=args.queue_size)
+    if args.connect is not None:
+        remote = service.RemoteServer(*service.parse_address(args.connect), pdata_path=util.pdata_path)
+        try:
+            Pipeline(remote, remote_client(remote, args.client), **options).run(paths)
+            errors = remote.flush()
+            if len(errors) > 0:
+                print(f"{len(errors)} vouchers were rejected")
+        finally:
+            remote.close()
+            if args.metrics is not None:
+                metrics.write(args.metrics)
+        return
+    storage = Storage(util.state_dir)
+    if storage.exists():
+        server = storage.load()
+    else:
+        server = storage.create(Server("Apple", voucher_path=storage.voucher_path))
+    try:
+        if args.client not in server.registry:
+            server.add_client(Client(args.client, server))
+        Pipeline(server, server.get_client(args.client), **options).run(paths)
+        if args.process:
+            server.process_vouchers(args.process_workers)
+        storage.checkpoint(server)
+    finally:
+        storage.close()
+        if args.metrics is not None:
+            metrics.write(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+class ClientRegistry:
+    """Clients by ID with stable integer handles, a deleted client leaves a tombstone so that no handle moves"""
+    cache = None  # IDs and clients of the registered clients as tuples, until the next add or remove
+
+    def __init__(self):
+        self.handles = dict()  # client ID -> handle
+        self.ids = list()  # client ID by handle, None for deleted clients
+        self.clients = list()  # client by handle
+        self.states = list()  # processing state by handle
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('cache', None)
+        return state
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __contains__(self, client_id):
+        return client_id in self.handles
+
+    def handle(self, client_id):
+        """Returns the handle of a client, raises KeyError for unknown IDs"""
+        return self.handles[client_id]
+
+    def add(self, client, state):
+        """Registers a client with its processing state, returns its handle or None if the ID is taken"""
+        if client.id in self.handles:
+            return None
+        handle = len(self.ids)
+        self.cache = None
+        self.handles[client.id] = handle
+        self.ids.append(client.id)
+        self.clients.append(client)
+        self.states.append(state)
+        return handle
+
+    def add_many(self, clients, new_state):
+        """Registers many clients at once, new_state creates the processing state of every client,
+        returns the handles of the clients that were added"""
+        fresh = dict()
+        for client in clients:
+            if client.id not in self.handles and client.id not in fresh:
+                fresh[client.id] = client
+        start = len(self.ids)
+        self.cache = None
+        self.handles.update(zip(fresh, range(start, start + len(fresh))))
+        self.ids.extend(fresh)
+        self.clients.extend(fresh.values())
+        self.states.extend(new_state() for _ in range(len(fresh)))
+        return list(range(start, start + len(fresh)))
+
+    def remove(self, client_id):
+        """Deletes a client and leaves a tombstone, returns its handle or None for unknown IDs"""
+        handle = self.handles.pop(client_id, None)
+        if handle is not None:
+            self.cache = None
+            self.ids[handle] = None
+            self.clients[handle] = None
+            self.states[handle] = None
+        return handle
+
+    def live(self):
+        """Returns the handles of all registered clients in order of registration, as a view of the registry"""
+        return self.handles.values()
+
+    def listing(self):
+        """Returns the IDs and the clients of all registered clients in order of registration as tuples, built
+        once after every change instead of on every access"""
+        if self.cache is None:
+            self.cache = (tuple(self.handles), tuple(self.clients[h] for h in self.handles.values()))
+        return self.cache
@@ -0,0 +1,68 @@
+import os
+import threading
+
+
+class Segment:
+    """Append-only file holding the ciphertexts of streamed ADs, referenced by offset and length
+
+    A ciphertext of known length can also be written block by block into a range reserved for it, so that
+    several of them are received at the same time without holding them in memory. The range of a ciphertext
+    that is never completed stays unused."""
+    end = None  # offset behind the last appended or reserved range, the file size when first needed
+    fd = None  # descriptor for writes into reserved ranges
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('lock')
+        state.pop('end', None)
+        state.pop('fd', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def append(self, blocks):
+        """Appends the blocks of one ciphertext, returns its (offset, length)"""
+        with self.lock:
+            if self.end is None:
+                self.end = self.size()
+            offset = self.end
+            # not in append mode, the file may still end before a reserved range
+            with os.fdopen(os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o666), 'wb') as f:
+                f.seek(offset)
+                for block in blocks:
+                    f.write(block)
+                length = f.tell() - offset
+            self.end = offset + length
+        return offset, length
+
+    def reserve(self, length):
+        """Reserves a range of length bytes for a ciphertext that is written with write_at, returns its offset"""
+        with self.lock:
+            if self.end is None:
+                self.end = self.size()
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o666)
+            offset = self.end
+            self.end += length
+        return offset
+
+    def write_at(self, offset, block):
+        """Writes a block into a reserved range"""
+        view = memoryview(block)
+        while len(view) > 0:
+            n = os.pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    def size(self):
+        """Returns the number of bytes in the segment"""
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
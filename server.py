@@ -1,74 +1,287 @@
+import copy
+import functools
 import json
 import math
+import multiprocessing
 import os
 import random
 import shutil
+import time
+import cuckoo
+import ecc
+import imagewriter
+import metrics
+import numpy as np
+import segment
+import shamir
 import util
 import nnhash
+import registry
+import voucherstore
+import wire
 
-from Crypto.PublicKey import ECC
+from client import Voucher
+
+
+def scan_images(path):
+    """Streams the paths of all images in a directory"""
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.endswith(".jpg") or entry.name.endswith(".png") or entry.name.endswith(".jpeg"):
+                yield entry.path
+
+
+def hash_images(paths, batch_size):
+    """Hashes a chunk of images with the NeuralHash engine of the current process"""
+    batches = util.chunked(paths, batch_size)
+    return [h for hashes in nnhash.get_hasher().hash_stream(batches) for h in hashes]
 
 
 # server setup - step 0:
-def process_X():
+def process_X(workers=1, batch_size=16, report_every=1000):
+    """Hashes all malicious images, using a pool of worker processes if workers > 1"""
     x = list()
-    for img in os.listdir(util.mal_img_dir):
-        if img.endswith(".jpg") or img.endswith(".png") or img.endswith(".jpeg"):
-            nh = nnhash.calc_nnhash(util.mal_img_dir + img)
-            x.append(nh)
+    start = time.perf_counter()
+    if workers > 1:
+        # every worker holds its own model session and hashes chunks of several batches
+        pool = multiprocessing.Pool(workers, initializer=nnhash.get_hasher)
+        chunks = util.chunked(scan_images(util.mal_img_dir), batch_size * 4)
+        results = pool.imap(functools.partial(hash_images, batch_size=batch_size), chunks)
+    else:
+        pool = None
+        batches = util.chunked(scan_images(util.mal_img_dir), batch_size)
+        results = nnhash.get_hasher().hash_stream(batches)
+    try:
+        reported = 0
+        for hashes in results:
+            x.extend(hashes)
+            if len(x) - reported >= report_every:
+                reported = len(x)
+                elapsed = time.perf_counter() - start
+                print(f"hashed {len(x)} images ({len(x) / elapsed:.1f} images/s)")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.perf_counter() - start
+    print(f"hashed {len(x)} images in {elapsed:.1f}s")
     # Remove any duplicates from x
     x = list(dict.fromkeys(x))
     return x
 
 
+class VoucherDecryptor:
+    """Batch engine recovering the rkeys of many vouchers with the fixed server secret alpha"""
+    def __init__(self, alpha):
+        self.alpha = alpha % util.ecc_q
+
+    def recover(self, vouchers):
+        """Returns the rkey of every voucher, None if neither or both halves decrypt"""
+        # S = alpha * Q for both halves of all vouchers, in one pass over the native multiplication
+        phases = metrics.phases("process_vouchers")
+        points = [Q for v in vouchers for Q in (v.Q1, v.Q2)]
+        S = [ecc.mul(self.alpha, Q) for Q in points]
+        phases.mark("point_multiply")
+        # a point at infinity has no key, aes128_dec fails for it like for a wrong key
+        keys = [util.calc_H_dash(P) if P is not None else None for P in S]
+        rkeys = list()
+        for i, v in enumerate(vouchers):
+            rkey1 = util.aes128_dec(keys[2 * i], v.ct1)
+            rkey2 = util.aes128_dec(keys[2 * i + 1], v.ct2)
+            if (rkey1 is None) == (rkey2 is None):
+                rkeys.append(None)
+            else:
+                rkeys.append(rkey1 if rkey1 is not None else rkey2)
+        phases.mark("key_recovery")
+        if metrics.enabled:
+            metrics.inc("vouchers_decided_total", len(vouchers))
+            metrics.inc("trial_decrypt_failures_total", rkeys.count(None))
+        return rkeys
+
+
+class ClientState:
+    """Processing state of a client, every voucher is decided only once"""
+    def __init__(self):
+        self.processed = 0  # number of vouchers already decided
+        self.SHARES = list()  # (id, adct) of matching vouchers, kept until adkey is reconstructed
+        self.dist_sh = dict()  # distinct shares in order of arrival, dropped once adkey is reconstructed
+        self.adkey = None  # reconstructed adkey once more than t distinct shares arrived
+
+    def copy(self):
+        """Returns a copy that is changed by processing without changing this state"""
+        state = copy.copy(self)
+        state.SHARES = list(self.SHARES)
+        state.dist_sh = dict(self.dist_sh)
+        return state
+
+
+def process_client_vouchers(alpha, t, state, vouchers):
+    """Processes the new vouchers of a single client, returns the updated copy of its state, their IDLIST and
+    the (id, ad) pairs decrypted by this call
+
+    Streamed ADs are left in the AD segment for the image writer, their pair holds the (offset, length)."""
+    state = state.copy()
+    IDLIST = list()
+    OUTSET = list()
+    # step 1
+    rkeys = VoucherDecryptor(alpha).recover(vouchers)
+    phases = metrics.phases("process_vouchers")
+    for v, rkey in zip(vouchers, rkeys):
+        IDLIST.append(v.id)
+        if rkey is None:
+            continue
+        rct_dec = util.aes128_dec(rkey, v.rct)
+        if rct_dec is None:
+            continue
+        if wire.is_binary(v.rct):
+            adct, sh = wire.decode_rct(rct_dec)
+            adct = bytes(adct)
+        else:
+            # vouchers in the old JSON format
+            rct = json.loads(rct_dec)
+            adct = rct['adct']
+            sh = util.parse_share(rct['sh'])
+        # a streamed adct is kept as its (offset, length) in the AD segment
+        state.SHARES.append((v.id, adct if v.adref is None else tuple(v.adref)))
+        if state.adkey is None:
+            state.dist_sh[sh] = None
+    state.processed += len(vouchers)
+    phases.mark("threshold")
+    # step 2, reconstruct adkey the moment the client crosses the threshold
+    if state.adkey is None and len(state.dist_sh) > t:
+        start = time.perf_counter()
+        shares = [util.parse_share(sh) for sh in state.dist_sh]
+        adkey_int, bad = shamir.reconstruct(shares, t)
+        if bad:
+            util.log(f"skipped {len(bad)} inconsistent shares", util.INFO)
+        if adkey_int is not None:
+            state.adkey = int.to_bytes(adkey_int, 16, "big")
+            # the state stays O(t) in snapshots and log records
+            state.dist_sh = dict()
+        if metrics.enabled:
+            metrics.observe("reconstruction_seconds", time.perf_counter() - start)
+            metrics.observe("shares_per_client", len(shares), metrics.COUNTS)
+            metrics.inc("inconsistent_shares_total", len(bad))
+        phases.mark("reconstruction")
+    if state.adkey is not None:
+        for s in state.SHARES:
+            ad = s[1] if isinstance(s[1], tuple) else util.aes128_dec(state.adkey, s[1])
+            if ad is not None:
+                OUTSET.append((s[0], ad))
+        state.SHARES = list()
+        phases.mark("image_decrypt")
+    return state, IDLIST, OUTSET
+
+
+class PdataDelta:
+    """Changed pdata entries of one update of the malicious set, as (index, point) pairs"""
+    def __init__(self, version, size, entries, full=False):
+        self.version = version  # pdata version after applying the delta
+        self.size = size  # length of pdata after applying the delta
+        self.entries = entries
+        self.full = full  # the cuckoo table was rebuilt and entries hold the whole pdata
+
+
 class Server:
     """Represents the server in the tPSI-AD protocol"""
-    def __init__(self, name):
+    storage = None  # optional storage.Storage logging every change, never pickled
+    writer = None  # imagewriter.ImageWriter of the decrypted images, created on first use and never pickled
+
+    def __init__(self, name, setup_workers=1, X=None, voucher_path=None):
         self.name = name
-        # keep lists for clients, IDs and vouchers
-        self.client_list = list()
-        self.client_id_list = list()
-        self.client_voucher_list = list()
+        # clients and their processing states by ID and stable handle, vouchers refer to the handle
+        self.registry = registry.ClientRegistry()
+        # vouchers of all clients, memory-mapped from the files in voucher_path if it is given
+        self.vouchers = voucherstore.VoucherStore(voucher_path)
+        self.auto_process = False  # process every voucher on receipt instead of on process_vouchers
         self.cur_id = 0  # starting value for triple IDs
         self.t = 3  # threshold value
-        self.X = process_X()  # server setup - step 0
+        # server setup - step 0, X can also be passed as precomputed hashes
+        self.X = process_X(setup_workers) if X is None else list(dict.fromkeys(X))
+        self.X_index = {x: i for i, x in enumerate(self.X)}  # position of every hash in X
         self.h1_index = 0  # index of cuckoo h_1
         self.h2_index = 1  # index of cuckoo h_2
         self.e_dash = 0.3  # factor for size of cuckoo
         self.n_dash = int((1 + self.e_dash) * len(self.X))  # size of cuckoo table
-        self.select_cuckoo_hashes(0)  # select hash functions for cuckoo table
-        self.cuckoo_table = self.create_cuckoo_table()  # server setup - step 1
+        # select hash functions and create the cuckoo table - server setup step 1
+        self.cuckoo_table = self.place_X()
         self.alpha = random.randint(0, util.ecc_q)  # server setup - step 2
-        self.L = (int((self.alpha * util.ecc_gen).x), int((self.alpha * util.ecc_gen).y))
+        self.L = ecc.mul_base(self.alpha)
         self.pdata = self.calc_pdata()  # server setup - step 3 & 4
+        self.pdata_version = 0  # increased on every change of the malicious set
+        self.segment = segment.Segment(util.ad_segment_path)  # ciphertexts of streamed ADs
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('storage', None)
+        state.pop('writer', None)
+        return state
+
+    @property
+    def client_list(self):
+        """All registered clients in order of registration"""
+        return self.registry.listing()[1]
+
+    @property
+    def client_id_list(self):
+        """IDs of all registered clients in order of registration"""
+        return self.registry.listing()[0]
+
+    @property
+    def client_state_list(self):
+        """Processing states of all registered clients in order of registration"""
+        return [self.registry.states[h] for h in self.registry.live()]
+
+    def get_client(self, client_id):
+        """Returns the client with the given ID, raises KeyError for unknown IDs"""
+        return self.registry.clients[self.registry.handle(client_id)]
 
     def add_client(self, client):
         """Adds the given client to the server."""
-        if client.id not in self.client_id_list:
-            self.client_list.append(client)
-            self.client_id_list.append(client.id)
-            self.client_voucher_list.append(list())
+        if self.registry.add(client, ClientState()) is not None:
+            if self.storage is not None:
+                self.storage.log_client_add(client)
             print(f"client {client.id} was added")
-            # create new directory for images of client
-            path = os.path.join(util.clients_dir, client.id)
-            try:
-                os.mkdir(path, 0o777)
-                print(f"added dir: {path}")
-            except OSError:
-                pass
+            self.create_client_dir(client.id)
         else:
             print(f"ID {client.id} was already found")
 
+    def add_clients(self, clients, create_dirs=True):
+        """Adds many clients at once, IDs that are already registered are skipped"""
+        clients = list(clients)
+        handles = self.registry.add_many(clients, ClientState)
+        added = [self.registry.clients[h] for h in handles]
+        if self.storage is not None:
+            for client in added:
+                self.storage.log_client_add(client)
+        if create_dirs:
+            for client in added:
+                self.create_client_dir(client.id)
+        print(f"{len(added)} clients were added, {len(clients) - len(added)} IDs were already found")
+        return handles
+
+    def create_client_dir(self, client_id):
+        """Creates the directory for the images of a client"""
+        path = os.path.join(util.clients_dir, client_id)
+        try:
+            os.mkdir(path, 0o777)
+            print(f"added dir: {path}")
+        except OSError:
+            pass
+
     def delete_client(self, client_id):
         """Deletes client from the server for a given client id"""
-        if client_id in self.client_id_list:
-            index = self.client_id_list.index(client_id)
-            self.client_list.pop(index)
-            self.client_id_list.pop(index)
-            self.client_voucher_list.pop(index)
+        if client_id in self.registry:
+            if self.storage is not None:
+                self.storage.log_client_delete(client_id)
+            self.vouchers.delete_client(self.registry.remove(client_id))
             print(f"client {client_id} was deleted")
             path_clients_dir = os.path.join(util.clients_dir, client_id)
             path_dec_img_dir = os.path.join(util.dec_img_dir, client_id)
+            # queued images of the client would recreate its directory
+            self.flush_images()
+            if self.writer is not None:
+                self.writer.forget(f"{util.dec_img_dir}{client_id}/")
             try:
                 shutil.rmtree(path_clients_dir)
                 print(f"deleted dir: {path_clients_dir}")
@@ -86,141 +299,279 @@ class Server:
         """Increases the current triple ID counter"""
         self.cur_id += 1
 
-    def select_cuckoo_hashes(self, cnt):
-        """Selects two hash function used for the cuckoo table"""
+    def select_cuckoo_hashes(self):
+        """Selects two hash function used for the cuckoo table, hashing X at most once per function"""
         l = len(util.hash_func_list)
-        if cnt == math.factorial(l):
-            print(f"Could not find usable hash functions in {cnt} tries")
-            return
-        collision = False
-        for i in self.X:
-            h1_x, h2_x = util.calc_h(i, self.n_dash, self.h1_index, self.h2_index)
-            if h1_x == h2_x:
-                collision = True
-                self.h1_index = random.randint(0, l - 1)
-                self.h2_index = random.randint(0, l - 1)
-                while self.h1_index == self.h2_index:
-                    self.h2_index = random.randint(0, l - 1)
+        slots = dict()
+        for cnt in range(math.factorial(l) + 1):
+            for i in (self.h1_index, self.h2_index):
+                if i not in slots:
+                    slots[i] = util.calc_h_many(self.X, self.n_dash, i)
+            # retry as long as a collision occurs
+            if not np.any(slots[self.h1_index] == slots[self.h2_index]):
                 break
-        # retry as long as a collision occurs
-        if collision:
-            self.select_cuckoo_hashes(cnt + 1)
+            if cnt == math.factorial(l):
+                print(f"Could not find usable hash functions in {cnt} tries")
+                break
+            self.h1_index = random.randint(0, l - 1)
+            self.h2_index = random.randint(0, l - 1)
+            while self.h1_index == self.h2_index:
+                self.h2_index = random.randint(0, l - 1)
+        self.cuckoo_hashes = (slots[self.h1_index], slots[self.h2_index])
 
     # Server setup - step 1:
     def create_cuckoo_table(self):
-        """Creates the cuckoo table and inserts all hashes"""
-        cuckoo_table = dict.fromkeys((range(self.n_dash)))
-        for i in self.X:
-            self.cuckoo_insert(i, 0, 0, cuckoo_table)
-        return cuckoo_table
-
-    def cuckoo_insert(self, x, n, cnt, cuckoo_table):
-        """Inserts a specific hash into the cuckoo table"""
-        h1_x, h2_x = util.calc_h(x, self.n_dash, self.h1_index, self.h2_index)
-        hashes = list()
-        hashes.append(h1_x)
-        hashes.append(h2_x)
-        # if hash is already in the table, discard it
-        if cuckoo_table[h1_x] == x or cuckoo_table[h2_x] == x:
-            return
-        # if there is a cycle, discard the current hash
-        if cnt == self.n_dash:
-            print(f"Cycle detected, {x} discarded")
-            return
-        # if slot in table is free, insert it
-        if cuckoo_table[hashes[n]] is None:
-            cuckoo_table[hashes[n]] = x
-            return
-        # otherwise move hash currently in slot to its alternating position and insert hash afterwards
-        else:
-            old_x = cuckoo_table[hashes[n]]
-            h1_old_x, h2_old_x = util.calc_h(old_x, self.n_dash, self.h1_index, self.h2_index)
-            cuckoo_table[hashes[n]] = x
-            new_n = 0
-            if n == 0:
-                if h1_old_x == h1_x:
-                    new_n = 1
-            else:
-                if h1_old_x == h2_x:
-                    new_n = 1
-            self.cuckoo_insert(old_x, new_n, cnt + 1, cuckoo_table)
+        """Creates the cuckoo table and inserts all hashes, returns the hash stored in every slot"""
+        self.cuckoo = cuckoo.CuckooTable(self.n_dash, *self.cuckoo_hashes).build()
+        st = self.cuckoo.stats()
+        print(f"cuckoo table: load factor {st['load_factor']:.3f}, {st['evictions']} evictions, "
+              f"longest chain {st['longest_chain']}, {st['stashed']} stashed, {st['discarded']} discarded")
+        return [self.X[i] if i >= 0 else None for i in self.cuckoo.slots.tolist()]
+
+    def place_X(self):
+        """Selects the hash functions and creates the cuckoo table, growing it until every hash has a slot,
+        a hash in the stash has no pdata entry and its vouchers could never match"""
+        while True:
+            self.select_cuckoo_hashes()
+            cuckoo_table = self.create_cuckoo_table()
+            if len(self.cuckoo.stash) == 0 and len(self.cuckoo.discarded) == 0:
+                return cuckoo_table
+            self.n_dash = max(int((1 + self.e_dash) * self.n_dash), self.n_dash + 1)
 
     # Server setup - step 3 & 4
     def calc_pdata(self):
         """Calculates pdata according to tPSI-AD protocol"""
         pdata = list()
         pdata.append(self.L)
-        for i in self.cuckoo_table:
-            if self.cuckoo_table[i] is None:
-                rand = random.randint(0, util.ecc_q)
-                ecc_P = rand * util.ecc_gen
-            else:
-                ecc_P = self.alpha * util.calc_H(self.cuckoo_table[i])
-            P = (int(ecc_P.x), int(ecc_P.y))
-            pdata.append(P)
+        for x in self.cuckoo_table:
+            pdata.append(self.calc_pdata_entry(x))
         return pdata
 
+    def calc_pdata_entry(self, x):
+        """Calculates the pdata point of a cuckoo slot holding x, a random point if the slot is empty"""
+        if x is None:
+            rand = random.randint(0, util.ecc_q)
+            return ecc.mul_base(rand)
+        # alpha * H(x) = (alpha * h) * G, so both cases use the generator's comb table
+        return ecc.mul_base(self.alpha * util.calc_H_int(x))
+
+    def update_slots(self, slots):
+        """Recalculates the pdata points of the given cuckoo slots if their contents changed, returns the delta"""
+        entries = list()
+        for s in sorted(set(slots)):
+            i = int(self.cuckoo.slots[s])
+            x = self.X[i] if i >= 0 else None
+            if x == self.cuckoo_table[s]:
+                continue
+            self.cuckoo_table[s] = x
+            P = self.calc_pdata_entry(x)
+            self.pdata[s + 1] = P
+            entries.append((s + 1, P))
+        self.pdata_version += 1
+        return PdataDelta(self.pdata_version, len(self.pdata), entries)
+
+    def rebuild(self, grow=False):
+        """Rebuilds cuckoo table and pdata for the current malicious set, returns the delta with the whole pdata"""
+        self.X = [x for x in self.X if x is not None]
+        self.X_index = {x: i for i, x in enumerate(self.X)}
+        n_dash = int((1 + self.e_dash) * len(self.X))
+        if grow:
+            n_dash = max(n_dash, int((1 + self.e_dash) * self.n_dash), self.n_dash + 1)
+        self.n_dash = n_dash
+        self.cuckoo_table = self.place_X()
+        self.pdata = self.calc_pdata()
+        self.pdata_version += 1
+        return PdataDelta(self.pdata_version, len(self.pdata), list(enumerate(self.pdata)), full=True)
+
+    def publish(self, delta):
+        """Sends a pdata delta to all clients, checkpoints the new setup and returns the delta"""
+        for handle in self.registry.live():
+            self.registry.clients[handle].apply_pdata_delta(delta)
+        print(f"pdata version {delta.version}: {len(delta.entries)} changed entries")
+        if self.storage is not None:
+            self.storage.checkpoint(self)
+        return delta
+
+    def add_to_X(self, xs):
+        """Adds hashes to the malicious set, recomputing only the pdata entries of changed cuckoo slots,
+        the table is rebuilt only if it has to grow or a new hash has the same slot under both hash functions"""
+        changed = list()
+        left_out = len(self.cuckoo.stash) + len(self.cuckoo.discarded)
+        collision = False
+        for x in xs:
+            if x in self.X_index:
+                print(f"{x} is already in X")
+                continue
+            w1, w2 = util.calc_h(x, self.n_dash, self.h1_index, self.h2_index)
+            self.X_index[x] = len(self.X)
+            self.X.append(x)
+            changed.extend(self.cuckoo.add(w1, w2))
+            # both halves of a voucher would decrypt, so the hash functions have to be selected again
+            collision = collision or w1 == w2
+        if collision:
+            return self.publish(self.rebuild())
+        if len(self.cuckoo.stash) + len(self.cuckoo.discarded) > left_out:
+            # an eviction chain ended without a slot, the new hash or an evicted one would be missing in pdata
+            return self.publish(self.rebuild(grow=True))
+        return self.publish(self.update_slots(changed))
+
+    def remove_from_X(self, xs):
+        """Removes hashes from the malicious set, recomputing only the pdata entries of changed cuckoo slots"""
+        changed = list()
+        for x in xs:
+            i = self.X_index.pop(x, None)
+            if i is None:
+                print(f"{x} was not found in X")
+                continue
+            changed.extend(self.cuckoo.remove(i))
+            self.X[i] = None
+        return self.publish(self.update_slots(changed))
+
     def receive_voucher(self, client, voucher):
         """Receives a voucher from a client and adds it to list of voucher"""
-        index = self.client_id_list.index(client.id)
-        self.client_voucher_list[index].append(voucher)
-        print(f"{self.name} received voucher with ID {voucher.id} from {client.id}")
+        self.receive_vouchers(client, [voucher])
 
-    def process_vouchers(self):
-        """Processes the set of received vouchers according to tPSI-AD protocol"""
-        print("processing vouchers")
-        index = -1
-        IDLIST_GLOBAL = list()
-        OUTSET_GLOBAL = list()
-        for cl in self.client_voucher_list:
-            index = index + 1
-            # step 0
-            SHARES = list()
-            IDLIST = list()
-            for v in cl:
-                # step 1
-                IDLIST.append(v.id)
-                Q1 = ECC.EccPoint(x=v.Q1[0], y=v.Q1[1], curve='p256')
-                Q2 = ECC.EccPoint(x=v.Q2[0], y=v.Q2[1], curve='p256')
-                S1 = self.alpha * Q1
-                S2 = self.alpha * Q2
-                rkey1 = util.aes128_dec(util.calc_H_dash(S1), v.ct1)
-                rkey2 = util.aes128_dec(util.calc_H_dash(S2), v.ct2)
-                if rkey1 is None and rkey2 is None:
-                    continue
-                elif rkey1 is not None and rkey2 is not None:
-                    continue
-                elif rkey1 is not None:
-                    rct_dec = util.aes128_dec(rkey1, v.rct)
+    def receive_vouchers(self, client, batch):
+        """Receives a batch of vouchers from a client, with auto_process the batch is processed in one go,
+        if its images cannot be written it is left to process_vouchers"""
+        handle = self.registry.handle(client.id)
+        rows = list()
+        for voucher in batch:
+            if self.storage is not None:
+                self.storage.log_voucher(client.id, voucher)
+            rows.append(self.vouchers.append(handle, voucher))
+            util.log(f"{self.name} received voucher with ID {voucher.id} from {client.id}")
+        if metrics.enabled:
+            metrics.inc("vouchers_received_total", len(rows))
+        if self.auto_process and len(rows) > 0:
+            previous = self.registry.states[handle]
+            OUTSET = self.apply_result(handle, *process_client_vouchers(self.alpha, self.t, previous, batch))
+            self.settle([(handle, previous, rows, OUTSET)])
+
+    def receive_ad(self, blocks, length=None):
+        """Receives the ciphertext of a streamed AD block by block, returns its (offset, length) in the AD segment,
+        the expected length is only needed by a service.RemoteServer"""
+        return self.segment.append(blocks)
+
+    def image_dir(self, handle):
+        """Returns the output directory for the decrypted images of a client"""
+        return f"{util.dec_img_dir}{self.registry.ids[handle]}/"
+
+    def receive_voucher_bytes(self, client, data):
+        """Receives a voucher in the binary wire format, its ciphertexts stay views into data"""
+        self.receive_voucher(client, Voucher.from_bytes(data))
+
+    def apply_result(self, handle, state, IDLIST, OUTSET):
+        """Stores the new processing state of a client and saves newly decrypted images,
+        returns OUTSET, or the IDs of the matching vouchers if adkey is not reconstructed yet"""
+        self.registry.states[handle] = state
+        if state.adkey is None:
+            return [s[0] for s in state.SHARES]
+        if len(OUTSET) > 0:
+            path = self.image_dir(handle)
+            phases = metrics.phases("process_vouchers")
+            writer = self.image_writer()
+            for i, (id, ad) in enumerate(OUTSET):
+                if isinstance(ad, tuple):
+                    # a streamed AD is decrypted from the AD segment by the writer, its pair gets the file path
+                    writer.save_stream(path, id, state.adkey, self.segment.path, ad)
+                    OUTSET[i] = (id, f"{path}{id}.png")
                 else:
-                    rct_dec = util.aes128_dec(rkey2, v.rct)
-                if rct_dec is not None:
-                    rct = json.loads(rct_dec)
-                    adct = rct['adct']
-                    sh = rct['sh']
-                    SHARES.append((v.id, adct, sh))
-            # step 2
-            dist_sh = list()
-            for s in SHARES:
-                dist_sh.append(s[2])
-            dist_sh = list(dict.fromkeys(dist_sh))
-            t_dash = len(dist_sh)
-            if t_dash <= self.t:
-                OUTSET = ([x[0] for x in SHARES])
-                print("Not enough shares")
+                    writer.save(path, id, ad)
+            phases.mark("image_queue")
+        return OUTSET
+
+    def image_writer(self):
+        """Returns the writer of the decrypted images"""
+        if self.writer is None:
+            self.writer = imagewriter.ImageWriter()
+        return self.writer
+
+    def flush_images(self):
+        """Waits until all decrypted images are written, returns the failed writes"""
+        if self.writer is None:
+            return list()
+        errors = self.writer.flush()
+        if len(errors) > 0:
+            util.log(f"{len(errors)} decrypted images could not be written", util.INFO)
+        return errors
+
+    def settle(self, applied):
+        """Waits until the images of applied results are written, then logs the new states and marks their
+        vouchers processed. A client whose images could not all be written gets its previous state back and
+        its vouchers stay pending for the next run, its OUTSET is emptied. Streamed ADs that are not authentic
+        are dropped from OUTSET. applied holds (handle, previous state, rows, OUTSET returned by apply_result)"""
+        failed = set()
+        rejected = dict()  # output directory -> IDs of streamed ADs that are not authentic
+        for path, id, exe in self.flush_images():
+            if isinstance(exe, ValueError):
+                rejected.setdefault(path, set()).add(id)
             else:
-                adkey_int = util.recon_adkey(dist_sh[:self.t + 1])
-                adkey = int.to_bytes(adkey_int, 16, "big")
-                OUTSET = list()
-                for s in SHARES:
-                    ad = util.aes128_dec(adkey, s[1])
-                    if ad is not None:
-                        OUTSET.append((s[0], ad))
-                path = f"{util.dec_img_dir}{self.client_id_list[index]}/"
-                if not os.path.exists(path):
-                    os.mkdir(path, 0o777)
-                    print(f"Created Dir: {path}")
-                for t in OUTSET:
-                    util.save_image(t, path)
-            IDLIST_GLOBAL.append(IDLIST)
-            OUTSET_GLOBAL.append(OUTSET)
+                failed.add(path)
+        done = list()
+        back = list()
+        for handle, previous, rows, OUTSET in applied:
+            path = self.image_dir(handle)
+            if path in failed:
+                self.registry.states[handle] = previous
+                OUTSET.clear()
+                back.append(handle)
+                continue
+            if path in rejected:
+                OUTSET[:] = [p for p in OUTSET if p[0] not in rejected[path]]
+            if self.storage is not None:
+                self.storage.log_state(self.registry.ids[handle], self.registry.states[handle], rows)
+            done.append(rows)
+        if len(done) > 0:
+            self.vouchers.mark_processed(np.concatenate(done))
+        if len(back) > 0:
+            util.log(f"the vouchers of {len(back)} clients stay pending, their images could not be written", util.INFO)
+
+    def process_vouchers(self, workers=1):
+        """Processes the vouchers received since the last run according to tPSI-AD protocol, sharding
+        clients across a pool of worker processes if workers > 1"""
+        print("processing vouchers")
+        # results are listed by position of the client in order of registration
+        positions = {h: i for i, h in enumerate(self.registry.live())}
+        IDLIST_GLOBAL = [list() for _ in positions]
+        OUTSET_GLOBAL = [list() for _ in positions]
+        pending = list()
+        rows = self.vouchers.pending()
+        for handle, r in rows.items():
+            state = self.registry.states[handle]
+            vouchers = self.vouchers.get_many(r)
+            pending.append((handle, (self.alpha, self.t, state, vouchers)))
+        pool = None
+        if workers > 1 and len(pending) > 1:
+            # workers only receive alpha, t, the state and the new vouchers of their clients, streamed ADs
+            # are read from the AD segment
+            pool = multiprocessing.Pool(workers)
+            chunksize = max(1, len(pending) // (workers * 4))
+            if metrics.enabled:
+                # the values recorded in the workers are sent back with the results
+                results = metrics.merged(pool.starmap(metrics.Collect(process_client_vouchers),
+                                                      [p[1] for p in pending], chunksize))
+            else:
+                results = pool.starmap(process_client_vouchers, [p[1] for p in pending], chunksize)
+        else:
+            results = (process_client_vouchers(*p[1]) for p in pending)
+        waiting = 0
+        applied = list()  # (handle, previous state, rows, OUTSET) of the clients whose new state was applied
+        try:
+            for (handle, _), (state, IDLIST, OUTSET) in zip(pending, results):
+                previous = self.registry.states[handle]
+                OUTSET = self.apply_result(handle, state, IDLIST, OUTSET)
+                applied.append((handle, previous, rows[handle], OUTSET))
+                IDLIST_GLOBAL[positions[handle]] = IDLIST
+                OUTSET_GLOBAL[positions[handle]] = OUTSET
+                waiting += state.adkey is None
+            util.log(f"{waiting} of {len(pending)} clients do not have enough shares yet")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            # the new states are only logged once the images of their clients are written
+            self.settle(applied)
+            if self.storage is not None:
+                self.storage.commit()
+        return IDLIST_GLOBAL, OUTSET_GLOBAL
@@ -0,0 +1,473 @@
+"""Voucher ingestion over TCP or a Unix socket, so that clients run in other processes than the server
+
+A connection carries frames (see wire.py) and is reused for any number of vouchers and clients. Clients send
+vouchers without waiting for each other, the service hands every read to the server as one batch and answers
+with a single ACK for all vouchers of the read."""
+import argparse
+import asyncio
+import struct
+import threading
+import time
+
+from collections import deque
+
+import metrics
+import pdatamap
+import util
+import wire
+
+from client import Client, Voucher
+
+PORT = 7340
+
+
+class IngestProtocol(asyncio.Protocol):
+    """Server side of one connection"""
+    def __init__(self, service):
+        self.service = service
+        self.server = service.server
+        self.transport = None
+        self.buf = bytearray()
+        self.client = None  # client of the following vouchers, set by HELLO
+        self.received = 0  # vouchers received on this connection
+        self.acked = 0
+        self.batch = list()
+        self.ads = dict()  # AD number -> [offset, length, bytes written] of a streamed AD that is not complete yet
+        self.adrefs = dict()  # AD number -> adref of a complete AD that no voucher referred to yet
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buf += data
+        out = list()
+        off = 0
+        while len(self.buf) - off >= wire.FRAME.size:
+            length, kind = wire.FRAME.unpack_from(self.buf, off)
+            if length > wire.MAX_FRAME:
+                util.log(f"closing connection, frame of {length} bytes", util.INFO)
+                self.transport.close()
+                return
+            end = off + wire.FRAME.size + length
+            if end > len(self.buf):
+                break
+            payload = bytes(self.buf[off + wire.FRAME.size:end])
+            off = end
+            try:
+                known = self.handle(kind, payload, out)
+            except (ValueError, struct.error) as exe:
+                util.log(f"closing connection, {exe}", util.INFO)
+                self.transport.close()
+                return
+            if not known:
+                util.log(f"closing connection, unknown frame kind {kind}", util.INFO)
+                self.transport.close()
+                return
+        del self.buf[:off]
+        self.flush(out)
+        if len(out) > 0:
+            self.transport.write(b"".join(out))
+
+    def handle(self, kind, payload, out):
+        """Handles one frame, replies are added to out, returns False for unknown kinds and raises ValueError
+        for frames that end the connection"""
+        if kind == wire.VOUCHER or kind == wire.VOUCHER_AD:
+            number = self.received
+            self.received += 1
+            try:
+                if self.client is None:
+                    raise ValueError("voucher without an accepted HELLO")
+                if kind == wire.VOUCHER_AD:
+                    n = wire.AD_NUM.unpack_from(payload)[0]
+                    voucher = Voucher.from_bytes(memoryview(payload)[wire.AD_NUM.size:])
+                    if n not in self.adrefs:
+                        raise ValueError(f"unknown AD {n}")
+                    voucher.adref = self.adrefs.pop(n)
+                else:
+                    voucher = Voucher.from_bytes(payload)
+                    if voucher.adref is not None:
+                        raise ValueError("adref of a remote voucher")
+            except (ValueError, struct.error) as exe:
+                out.append(wire.encode_frame(wire.ERROR, wire.COUNT.pack(number), str(exe).encode()))
+                return True
+            self.batch.append(voucher)
+            if len(self.batch) >= self.service.batch_size:
+                self.flush(out)
+        elif kind == wire.AD_START:
+            n, length = wire.AD_NUM.unpack_from(payload)[0], wire.COUNT.unpack_from(payload, wire.AD_NUM.size)[0]
+            if len(self.ads) >= self.service.max_open_ads:
+                raise ValueError(f"more than {self.service.max_open_ads} open ADs")
+            if length > wire.MAX_AD:
+                raise ValueError(f"AD of {length} bytes")
+            # the blocks go straight into the AD segment, only their range is kept
+            self.ads[n] = [self.server.segment.reserve(length), length, 0]
+        elif kind == wire.AD:
+            n = wire.AD_NUM.unpack_from(payload)[0]
+            if n not in self.ads:
+                raise ValueError(f"block of AD {n} that was not started")
+            ad = self.ads[n]
+            block = memoryview(payload)[wire.AD_NUM.size:]
+            if ad[2] + len(block) > ad[1]:
+                raise ValueError(f"AD {n} is longer than announced")
+            self.server.segment.write_at(ad[0] + ad[2], block)
+            ad[2] += len(block)
+        elif kind == wire.AD_END:
+            n = wire.AD_NUM.unpack_from(payload)[0]
+            offset, length, written = self.ads.pop(n, (0, 0, -1))
+            if written != length:
+                raise ValueError(f"AD {n} ended after {written} of {length} bytes")
+            self.adrefs[n] = (offset, length)
+        elif kind == wire.HELLO:
+            self.flush(out)
+            self.client = None
+            try:
+                self.client = self.service.client(payload.decode())
+            except ValueError as exe:
+                util.log(f"rejected client ID {payload[:64]!r}: {exe}", util.INFO)
+                out.append(wire.encode_frame(wire.ERROR, wire.COUNT.pack(self.received), str(exe).encode()))
+        elif kind == wire.GET_PARAMS:
+            out.append(wire.encode_frame(wire.PARAMS, self.service.params()))
+        elif kind == wire.RESERVE:
+            count = wire.COUNT.unpack(payload)[0]
+            out.append(wire.encode_frame(wire.IDS, wire.COUNT.pack(self.server.cur_id), wire.COUNT.pack(count)))
+            self.server.cur_id += count
+        else:
+            return False
+        return True
+
+    def flush(self, out):
+        """Hands the collected vouchers to the server and acknowledges everything received so far"""
+        if len(self.batch) > 0:
+            self.server.receive_vouchers(self.client, self.batch)
+            self.batch = list()
+        if self.acked < self.received:
+            self.acked = self.received
+            out.append(wire.encode_frame(wire.ACK, wire.COUNT.pack(self.acked),
+                                         wire.COUNT.pack(self.server.pdata_version)))
+
+
+class IngestService:
+    """Accepts connections of remote clients and feeds their vouchers into a Server"""
+    def __init__(self, server, batch_size=256, max_open_ads=16):
+        self.server = server
+        self.batch_size = batch_size  # vouchers per receive_vouchers call
+        self.max_open_ads = max_open_ads  # streamed ADs a connection may send at the same time
+        self.encoded_params = None
+
+    def client(self, client_id):
+        """Returns the client with the given ID, unknown clients are registered by ID only, their secrets
+        stay in the client process. The ID names the directories of the client, so IDs that are not a plain
+        file name and IDs of clients of the server process itself raise ValueError"""
+        if client_id in ("", ".") or ".." in client_id or any(c in client_id for c in "/\\\0"):
+            raise ValueError("invalid client ID")
+        if client_id not in self.server.registry:
+            self.server.add_client(Client.restore(self.server, (client_id, None, None, None)))
+        client = self.server.get_client(client_id)
+        if client.adkey is not None:
+            raise ValueError("client ID of a local client")
+        return client
+
+    def params(self):
+        """Returns the encoded parameters clients need to generate vouchers"""
+        if self.encoded_params is None or self.encoded_params[0] != self.server.pdata_version:
+            self.encoded_params = (self.server.pdata_version, pdatamap.encode(self.server))
+        return self.encoded_params[1]
+
+    async def serve(self, host="127.0.0.1", port=PORT, path=None):
+        """Starts listening on a TCP port or on the Unix socket at path, returns the asyncio server"""
+        loop = asyncio.get_running_loop()
+        if path is not None:
+            return await loop.create_unix_server(lambda: IngestProtocol(self), path)
+        return await loop.create_server(lambda: IngestProtocol(self), host, port)
+
+
+def parse_address(address):
+    """Splits HOST:PORT into (host, port, None), anything else is the path of a Unix socket"""
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port), None
+    return None, None, address
+
+
+class Transport:
+    """Client side of a connection to the ingestion service, vouchers are sent without waiting for their ACK"""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.replies = deque()  # futures of PARAMS and IDS replies, in order of the requests
+        self.client_id = None
+        self.sent = 0
+        self.acked = 0
+        self.errors = list()  # (number, reason) of rejected vouchers
+        self.error = None  # exception that ended the connection
+        self.pdata_version = 0  # pdata version of the server in the last ACK
+        self.next_ad = 0
+        self.changed = asyncio.Condition()
+        self.reading = asyncio.ensure_future(self.read())
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=PORT, path=None):
+        """Connects to the service on a TCP port or on the Unix socket at path"""
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def read(self):
+        """Reads the replies of the service until the connection ends"""
+        try:
+            while True:
+                length, kind = wire.FRAME.unpack(await self.reader.readexactly(wire.FRAME.size))
+                payload = await self.reader.readexactly(length)
+                if kind == wire.ACK:
+                    self.acked = wire.COUNT.unpack_from(payload)[0]
+                    self.pdata_version = wire.COUNT.unpack_from(payload, wire.COUNT.size)[0]
+                elif kind == wire.ERROR:
+                    number = wire.COUNT.unpack_from(payload)[0]
+                    reason = payload[wire.COUNT.size:].decode()
+                    self.errors.append((number, reason))
+                    util.log(f"voucher {number} was rejected: {reason}", util.INFO)
+                    continue
+                else:
+                    self.replies.popleft().set_result(payload)
+                    continue
+                async with self.changed:
+                    self.changed.notify_all()
+        except (asyncio.IncompleteReadError, ConnectionError) as exe:
+            self.error = exe
+        while len(self.replies) > 0:
+            self.replies.popleft().set_exception(ConnectionError("connection to the ingestion service was closed"))
+        async with self.changed:
+            self.changed.notify_all()
+
+    def write(self, kind, *parts):
+        """Writes a frame"""
+        if self.error is not None:
+            raise ConnectionError("connection to the ingestion service was closed")
+        self.writer.write(wire.encode_frame(kind, *parts))
+
+    async def request(self, kind, *parts):
+        """Sends a request and waits for its reply"""
+        reply = asyncio.get_running_loop().create_future()
+        self.replies.append(reply)
+        self.write(kind, *parts)
+        return await reply
+
+    async def params(self):
+        """Fetches t, n_dash, h1_index, h2_index, the pdata version and pdata as a pdatamap.PdataMap"""
+        return pdatamap.PdataMap(await self.request(wire.GET_PARAMS))
+
+    async def reserve(self, count):
+        """Reserves count triple IDs, returns them as a range"""
+        payload = await self.request(wire.RESERVE, wire.COUNT.pack(count))
+        start = wire.COUNT.unpack_from(payload)[0]
+        return range(start, start + wire.COUNT.unpack_from(payload, wire.COUNT.size)[0])
+
+    async def open_ad(self, length):
+        """Starts a streamed AD of the given length, returns its number on this connection"""
+        n = self.next_ad
+        self.next_ad += 1
+        self.write(wire.AD_START, wire.AD_NUM.pack(n), wire.COUNT.pack(length))
+        return n
+
+    async def send_ad_block(self, n, block):
+        """Sends a block of a streamed AD"""
+        self.write(wire.AD, wire.AD_NUM.pack(n), block)
+        await self.writer.drain()
+
+    async def close_ad(self, n):
+        """Ends a streamed AD, its blocks are already in the AD segment of the service"""
+        self.write(wire.AD_END, wire.AD_NUM.pack(n))
+
+    async def send_ad(self, blocks, length):
+        """Streams an AD of the given length block by block, returns its number for the adref of its voucher"""
+        n = await self.open_ad(length)
+        for block in blocks:
+            await self.send_ad_block(n, block)
+        await self.close_ad(n)
+        return n
+
+    async def send_vouchers(self, client_id, vouchers, window=None):
+        """Sends vouchers of a client, a voucher whose adref is an int refers to the AD with this number
+
+        Returns once they are written and at most window vouchers are unacknowledged."""
+        if client_id != self.client_id:
+            self.write(wire.HELLO, client_id.encode())
+            self.client_id = client_id
+        for v in vouchers:
+            if isinstance(v.adref, int):
+                data = Voucher(v.id, v.Q1, v.ct1, v.Q2, v.ct2, v.rct).to_bytes()
+                self.write(wire.VOUCHER_AD, wire.AD_NUM.pack(v.adref), data)
+            else:
+                self.write(wire.VOUCHER, v.to_bytes())
+        self.sent += len(vouchers)
+        await self.drain(window)
+
+    async def drain(self, window=None):
+        """Waits until the written frames were passed on and at most window vouchers are unacknowledged"""
+        await self.writer.drain()
+        if window is not None:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.sent - self.acked <= window or self.error is not None)
+        if self.error is not None and self.acked < self.sent:
+            raise ConnectionError(f"connection closed with {self.sent - self.acked} unacknowledged vouchers")
+
+    async def flush(self):
+        """Waits until all sent vouchers are acknowledged, returns the rejected ones"""
+        await self.drain(0)
+        return self.errors
+
+    async def close(self):
+        """Waits for all ACKs and closes the connection"""
+        try:
+            await self.flush()
+        finally:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.reading.cancel()
+
+
+class RemoteServer:
+    """Stands in for the server of a client in another process, a Transport on a background event loop
+    forwards its ADs and vouchers to the ingestion service
+
+    Holds the parameters of the server, pdata stays encoded and its points are decoded on access. With
+    pdata_path, pdata is written to this file unless it already holds the same parameters and is mapped from
+    there, so that all client processes on a node share one copy. The service sends its pdata version with
+    every ACK, once it is newer the parameters are fetched again and the clients sending vouchers get the new
+    pdata, vouchers generated before are not generated again. Triple IDs are reserved from the server in
+    ranges, so that cur_id and inc_cur_id work as on the server."""
+    def __init__(self, host="127.0.0.1", port=PORT, path=None, window=4096, reserve=1024, pdata_path=None):
+        self.window = window  # unacknowledged vouchers before sending blocks
+        self.reserve = reserve  # triple IDs reserved at once
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.pdata_path = pdata_path
+        self.transport = self.call(Transport.connect(host, port, path))
+        self.fetch_params()
+        self.ids = range(0)
+        self.lock = threading.Lock()
+
+    def fetch_params(self):
+        """Fetches the parameters and pdata of the server"""
+        pdata = self.call(self.transport.params())
+        if self.pdata_path is not None:
+            if not pdatamap.matches(self.pdata_path, pdata.buf):
+                pdatamap.write(self.pdata_path, pdata.buf)
+            pdata = pdatamap.PdataMap.open(self.pdata_path)
+        self.t, self.n_dash, self.h1_index, self.h2_index = pdata.t, pdata.n_dash, pdata.h1_index, pdata.h2_index
+        self.pdata_version = pdata.version
+        self.pdata = pdata
+
+    def call(self, coro):
+        """Runs a coroutine on the event loop and waits for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    @property
+    def cur_id(self):
+        with self.lock:
+            if len(self.ids) == 0:
+                self.ids = self.call(self.transport.reserve(self.reserve))
+            return self.ids[0]
+
+    def inc_cur_id(self):
+        """Moves on to the next reserved triple ID"""
+        with self.lock:
+            self.ids = self.ids[1:]
+
+    def receive_ad(self, blocks, length=None):
+        """Streams an AD of the given length to the service, returns its number on the connection as adref"""
+        if length is None:
+            blocks = [bytes(b) for b in blocks]
+            length = sum(len(b) for b in blocks)
+        n = self.call(self.transport.open_ad(length))
+        for block in blocks:
+            self.call(self.transport.send_ad_block(n, block))
+        self.call(self.transport.close_ad(n))
+        return n
+
+    def receive_voucher(self, client, voucher):
+        self.receive_vouchers(client, [voucher])
+
+    def receive_vouchers(self, client, batch):
+        self.call(self.transport.send_vouchers(client.id, batch, self.window))
+        with self.lock:
+            if self.transport.pdata_version > self.pdata_version:
+                self.fetch_params()
+                util.log(f"pdata version {self.pdata_version} was fetched", util.INFO)
+        if client.pdata is not self.pdata:
+            client.pdata = self.pdata
+            client.pdata_version = self.pdata_version
+
+    def flush(self):
+        """Waits until the service acknowledged all vouchers, returns the rejected ones"""
+        return self.call(self.transport.flush())
+
+    def close(self):
+        """Flushes and closes the connection and stops the event loop"""
+        try:
+            self.call(self.transport.close())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+
+async def serve_forever(service, storage, host, port, path, checkpoint_interval, metrics_path=None):
+    """Serves until cancelled, writing a checkpoint and the metrics every checkpoint_interval seconds"""
+    listener = await service.serve(host, port, path)
+    print(f"listening on {path if path is not None else f'{host}:{port}'}")
+    try:
+        while True:
+            await asyncio.sleep(checkpoint_interval)
+            storage.checkpoint(service.server)
+            if metrics_path is not None:
+                metrics.write(metrics_path)
+    finally:
+        listener.close()
+        await listener.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receives vouchers of remote clients")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--unix", help="listen on a Unix socket at this path instead of TCP")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--max-open-ads", type=int, default=16, help="streamed ADs a connection may send at once")
+    parser.add_argument("--checkpoint-interval", type=float, default=300)
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="record metrics and write them to PATH, as Prometheus text for .prom, else as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every voucher")
+    args = parser.parse_args()
+    util.log_level = util.DEBUG if args.verbose else util.INFO
+    if args.metrics is not None:
+        metrics.enable()
+
+    # remote clients only import this module for the transport, the server is loaded here
+    from server import Server
+    from storage import Storage
+    storage = Storage(util.state_dir)
+    if storage.exists():
+        server = storage.load()
+    else:
+        server = storage.create(Server("Apple", voucher_path=storage.voucher_path))
+    service = IngestService(server, args.batch_size, args.max_open_ads)
+    start = time.perf_counter()
+    try:
+        asyncio.run(serve_forever(service, storage, args.host, args.port, args.unix, args.checkpoint_interval,
+                                  args.metrics))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"received {len(server.vouchers)} vouchers in total, served {time.perf_counter() - start:.0f}s")
+        storage.checkpoint(server)
+        storage.close()
+        if args.metrics is not None:
+            metrics.write(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
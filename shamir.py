@@ -0,0 +1,144 @@
+import functools
+
+# prime field of the shares, adkey is a 128-bit secret
+p = 340282366920938463463374607431768211297
+
+
+def evaluate(coeffs, x):
+    """Evaluates the polynomial with the given coefficients (constant term first) at x using Horner's rule"""
+    res = 0
+    for a in reversed(coeffs):
+        res = (res * x + a) % p
+    return res
+
+
+def batch_inverse(values):
+    """Inverts many non-zero field elements with a single modular inversion (Montgomery's trick)"""
+    prefix = list()
+    acc = 1
+    for v in values:
+        prefix.append(acc)
+        acc = acc * v % p
+    inv = pow(acc, -1, p)
+    res = [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        res[i] = inv * prefix[i] % p
+        inv = inv * values[i] % p
+    return res
+
+
+@functools.lru_cache(maxsize=256)
+def weights(xs):
+    """Barycentric weights 1 / prod_{j != i} (x_i - x_j) of a tuple of distinct x-coordinates"""
+    denominators = list()
+    for i, xi in enumerate(xs):
+        d = 1
+        for j, xj in enumerate(xs):
+            if i != j:
+                d = d * (xi - xj) % p
+        denominators.append(d)
+    return tuple(batch_inverse(denominators))
+
+
+@functools.lru_cache(maxsize=1024)
+def lagrange_coefficients(xs, x=0):
+    """Lagrange coefficients of a tuple of distinct x-coordinates for evaluating the interpolated polynomial
+    at x, cached for repeated x-sets"""
+    if x in xs:
+        return tuple(int(xi == x) for xi in xs)
+    diffs = [(x - xi) % p for xi in xs]
+    l = 1
+    for d in diffs:
+        l = l * d % p
+    return tuple(l * w * inv % p for w, inv in zip(weights(xs), batch_inverse(diffs)))
+
+
+def interpolate(shares, x=0):
+    """Evaluates the polynomial through the (x, z) shares at x, the secret for x = 0"""
+    coeffs = lagrange_coefficients(tuple(s[0] for s in shares), x)
+    return sum(c * z for c, (_, z) in zip(coeffs, shares)) % p
+
+
+def solve(rows):
+    """Solves a linear system given as rows of coefficients with the right-hand side last, free variables are
+    set to zero, returns None if the system is inconsistent"""
+    rows = [list(r) for r in rows]
+    m = len(rows[0]) - 1
+    pivots = list()
+    r = 0
+    for c in range(m):
+        k = next((k for k in range(r, len(rows)) if rows[k][c] % p), None)
+        if k is None:
+            continue
+        rows[r], rows[k] = rows[k], rows[r]
+        inv = pow(rows[r][c], -1, p)
+        rows[r] = [v * inv % p for v in rows[r]]
+        for k in range(len(rows)):
+            f = rows[k][c]
+            if k != r and f:
+                rows[k] = [(a - f * b) % p for a, b in zip(rows[k], rows[r])]
+        pivots.append(c)
+        r += 1
+        if r == len(rows):
+            break
+    if any(row[m] for row in rows[r:]):
+        return None
+    res = [0] * m
+    for row, c in zip(rows, pivots):
+        res[c] = row[m]
+    return res
+
+
+def divide(num, den):
+    """Divides two polynomials (constant term first), returns the quotient and the remainder"""
+    num = list(num)
+    inv = pow(den[-1], -1, p)
+    quot = [0] * max(0, len(num) - len(den) + 1)
+    for i in range(len(quot) - 1, -1, -1):
+        q = num[i + len(den) - 1] * inv % p
+        quot[i] = q
+        for j, d in enumerate(den):
+            num[i + j] = (num[i + j] - q * d) % p
+    return quot, num[:len(den) - 1]
+
+
+def decode(shares, t):
+    """Berlekamp-Welch decoding, returns the coefficients of the degree-t polynomial through all but at most
+    (n - t - 1) / 2 of the n shares, or None"""
+    e = (len(shares) - t - 1) // 2
+    if e <= 0:
+        return None
+    # Q(x) = z * E(x) for every share, Q of degree e + t and E monic of degree e
+    rows = list()
+    for x, z in shares:
+        powers = [1]
+        for _ in range(e + t):
+            powers.append(powers[-1] * x % p)
+        rows.append(powers + [-z * v % p for v in powers[:e]] + [z * powers[e] % p])
+    sol = solve(rows)
+    if sol is None:
+        return None
+    pol, rest = divide(sol[:e + t + 1], sol[e + t + 1:] + [1])
+    if any(rest) or sum(evaluate(pol, x) != z for x, z in shares) > e:
+        return None
+    return pol
+
+
+def reconstruct(shares, t):
+    """Reconstructs the secret from more than t distinct (x, z) shares and detects bad shares
+
+    The polynomial through the first t + 1 shares with distinct x is checked against all further shares. If one
+    of them is off, the shares are decoded with Berlekamp-Welch, which corrects up to (n - t - 1) / 2 bad
+    shares. Returns the secret and the shares off the polynomial, or None and all shares if the bad shares
+    cannot be told apart yet."""
+    shares = list(dict.fromkeys(shares))
+    # a basis needs distinct x, conflicting shares for the same x are only checked
+    basis = list(dict((x, (x, z)) for x, z in reversed(shares)).values())[::-1][:t + 1]
+    if len(basis) < t + 1:
+        return None, shares
+    if all(interpolate(basis, x) == z for x, z in shares):
+        return interpolate(basis), list()
+    pol = decode(shares, t)
+    if pol is None:
+        return None, shares
+    return pol[0] if pol else 0, [(x, z) for x, z in shares if evaluate(pol, x) != z]
@@ -0,0 +1,310 @@
+import copy
+import os
+import pickle
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from client import Client, Voucher
+from cuckoo import CuckooTable
+from server import ClientState, Server
+
+# log record: payload length, crc32 of kind and payload, kind
+RECORD = struct.Struct(">IIB")
+CLIENT_ADD = 1
+CLIENT_DELETE = 2
+VOUCHER = 3
+STATE = 4
+LEGACY_VOUCHER = 5  # voucher with JSON ciphertexts, pickled as it has no binary form
+
+# server attributes that are written as arrays or rebuilt on load instead of pickled with the snapshot
+ARRAYS = ('X', 'X_index', 'cuckoo_table', 'cuckoo_hashes', 'pdata', 'registry', 'storage', 'writer')
+
+
+class Log:
+    """Append-only log of records, fsynced in groups of records instead of after every record, a record is
+    durable at most group_interval seconds after it was appended"""
+    def __init__(self, path, group_size=64, group_interval=0.05):
+        self.path = path
+        self.group_size = group_size  # records per fsync
+        self.group_interval = group_interval  # seconds after which pending records are fsynced
+        self.f = open(path, 'ab')
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()
+        self.timer = None  # commits the pending records of a burst that ended before the group was full
+
+    def append(self, kind, payload):
+        """Appends a record, it is durable after the next commit"""
+        crc = zlib.crc32(payload, zlib.crc32(bytes([kind])))
+        with self.lock:
+            self.f.write(RECORD.pack(len(payload), crc, kind))
+            self.f.write(payload)
+            self.pending += 1
+            if self.pending >= self.group_size or time.monotonic() - self.last_sync >= self.group_interval:
+                self.sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.group_interval, self.commit)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def sync(self):
+        """Flushes and fsyncs the pending records, the lock has to be held"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending > 0 and not self.f.closed:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def commit(self):
+        """Makes all appended records durable"""
+        with self.lock:
+            self.sync()
+
+    def close(self):
+        """Commits and closes the log file"""
+        with self.lock:
+            self.sync()
+            self.f.close()
+
+
+def read_log(path):
+    """Yields (kind, payload) of all complete records and cuts off a torn or corrupt tail"""
+    if not os.path.exists(path):
+        return
+    valid = 0
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            length, crc, kind = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload, zlib.crc32(bytes([kind]))) != crc:
+                break
+            valid = f.tell()
+            yield kind, payload
+    if valid < os.path.getsize(path):
+        print(f"cut off torn log tail of {path} at {valid} bytes")
+        with open(path, 'r+b') as f:
+            f.truncate(valid)
+
+
+def pack_str(s):
+    """Encodes a length-prefixed string"""
+    b = s.encode()
+    return struct.pack(">H", len(b)) + b
+
+
+def unpack_str(buf):
+    """Decodes a length-prefixed string, returns it and the rest of the buffer"""
+    length = struct.unpack_from(">H", buf)[0]
+    return bytes(buf[2:2 + length]).decode(), buf[2 + length:]
+
+
+def write_file(path, data):
+    """Writes a file and forces it to disk"""
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_array(path, array):
+    """Writes an array in .npy format and forces it to disk"""
+    with open(path, 'wb') as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def fsync_dir(path):
+    """Forces the entries of a directory to disk"""
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class Storage:
+    """Durable server state: a snapshot of setup, clients and processing states, the voucher columns and an
+    append-only log of everything received since the snapshot
+
+    Every checkpoint writes a new snapshot generation next to the old one and switches CURRENT to it, so a
+    crash leaves either generation intact. Startup loads the snapshot, maps the arrays and replays the log,
+    independent of the number of stored vouchers."""
+    def __init__(self, path, group_size=64, group_interval=0.05):
+        self.path = path
+        self.voucher_path = os.path.join(path, "vouchers")
+        self.group_size = group_size
+        self.group_interval = group_interval
+        self.gen = None
+        self.log = None
+        os.makedirs(path, exist_ok=True)
+
+    def exists(self):
+        """Checks if a snapshot was written"""
+        return os.path.exists(os.path.join(self.path, "CURRENT"))
+
+    def snapshot_path(self, gen):
+        """Returns the directory of a snapshot generation"""
+        return os.path.join(self.path, f"snapshot-{gen}")
+
+    def log_path(self, gen):
+        """Returns the log file of a snapshot generation"""
+        return os.path.join(self.path, f"log-{gen}")
+
+    def create(self, server):
+        """Writes the first snapshot of a new server and attaches the storage to it"""
+        if server.vouchers.path != self.voucher_path:
+            raise ValueError(f"vouchers of the server have to be stored in {self.voucher_path}")
+        self.gen = 0
+        self.checkpoint(server)
+        return server
+
+    def checkpoint(self, server):
+        """Writes a snapshot of the server and starts a new empty log"""
+        if self.log is not None:
+            self.log.commit()
+        gen = self.gen + 1 if self.exists() else self.gen
+        path = self.snapshot_path(gen)
+        shutil.rmtree(path, ignore_errors=True)
+        os.mkdir(path)
+        server.vouchers.flush()
+        save_array(os.path.join(path, "X.npy"), np.array(["" if x is None else x for x in server.X], dtype=str))
+        cuckoo = server.cuckoo
+        save_array(os.path.join(path, "h1.npy"), cuckoo.h1)
+        save_array(os.path.join(path, "h2.npy"), cuckoo.h2)
+        save_array(os.path.join(path, "slots.npy"), cuckoo.slots)
+        pdata = b"".join(P[0].to_bytes(32, "big") + P[1].to_bytes(32, "big") for P in server.pdata)
+        save_array(os.path.join(path, "pdata.npy"), np.frombuffer(pdata, dtype=np.uint8).reshape(-1, 64))
+        state = {k: v for k, v in server.__dict__.items() if k not in ARRAYS}
+        state['cuckoo'] = {k: v for k, v in cuckoo.__dict__.items() if k not in ('h1', 'h2', 'slots')}
+        # clients are stored as their secrets, they refer to the server
+        registry = copy.copy(server.registry)
+        registry.clients = [None if c is None else c.keys() for c in registry.clients]
+        state['registry'] = registry
+        write_file(os.path.join(path, "server.pickle"), pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+        fsync_dir(path)
+        # switch to the new generation, the old one stays valid until CURRENT is replaced
+        old = self.gen if self.exists() else None
+        if os.path.exists(self.log_path(gen)):
+            # left over from a checkpoint that did not finish
+            os.remove(self.log_path(gen))
+        write_file(os.path.join(self.path, "CURRENT.tmp"), str(gen).encode())
+        os.replace(os.path.join(self.path, "CURRENT.tmp"), os.path.join(self.path, "CURRENT"))
+        fsync_dir(self.path)
+        if self.log is not None:
+            self.log.close()
+        self.gen = gen
+        self.log = Log(self.log_path(gen), self.group_size, self.group_interval)
+        server.storage = self
+        if old is not None and old != gen:
+            shutil.rmtree(self.snapshot_path(old), ignore_errors=True)
+            try:
+                os.remove(self.log_path(old))
+            except OSError:
+                pass
+        print(f"checkpoint {gen} written to {path}")
+
+    def load(self):
+        """Loads the server from the current snapshot and replays the log"""
+        with open(os.path.join(self.path, "CURRENT"), 'rb') as f:
+            self.gen = int(f.read())
+        path = self.snapshot_path(self.gen)
+        with open(os.path.join(path, "server.pickle"), 'rb') as f:
+            state = pickle.load(f)
+        server = Server.__new__(Server)
+        registry = state.pop('registry')
+        cuckoo = state.pop('cuckoo')
+        server.__dict__.update(state)
+        # the arrays are mapped copy-on-write, pages are only read when they are used
+        server.cuckoo = CuckooTable.__new__(CuckooTable)
+        server.cuckoo.__dict__.update(cuckoo)
+        for name in ('h1', 'h2', 'slots'):
+            setattr(server.cuckoo, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode='c'))
+        server.X = [x if x != "" else None for x in np.load(os.path.join(path, "X.npy")).tolist()]
+        server.X_index = {x: i for i, x in enumerate(server.X) if x is not None}
+        server.cuckoo_table = [server.X[i] if i >= 0 else None for i in server.cuckoo.slots.tolist()]
+        pdata = np.load(os.path.join(path, "pdata.npy"), mmap_mode='r')
+        server.pdata = [(int.from_bytes(P[:32], "big"), int.from_bytes(P[32:], "big"))
+                        for P in (bytes(row) for row in pdata)]
+        server.storage = None
+        registry.clients = [None if keys is None else Client.restore(server, keys) for keys in registry.clients]
+        server.registry = registry
+        self.replay(server)
+        self.log = Log(self.log_path(self.gen), self.group_size, self.group_interval)
+        server.storage = self
+        print(f"loaded checkpoint {self.gen} with {len(server.vouchers)} vouchers")
+        return server
+
+    def replay(self, server):
+        """Applies the log records written since the snapshot to registry, voucher store and cur_id, without
+        the directories of added and deleted clients, these were created or removed when the record was
+        written and belong to the last incarnation of a client ID"""
+        auto_process = server.auto_process
+        server.auto_process = False
+        cnt = 0
+        for kind, payload in read_log(self.log_path(self.gen)):
+            cnt += 1
+            if kind == CLIENT_ADD:
+                server.registry.add(Client.restore(server, pickle.loads(payload)), ClientState())
+            elif kind == CLIENT_DELETE:
+                client_id = payload.decode()
+                if client_id in server.registry:
+                    server.vouchers.delete_client(server.registry.remove(client_id))
+            elif kind == VOUCHER:
+                client_id, rest = unpack_str(payload)
+                voucher = Voucher.from_bytes(rest)
+                server.vouchers.append(server.registry.handle(client_id), voucher)
+                server.cur_id = max(server.cur_id, voucher.id + 1)
+            elif kind == LEGACY_VOUCHER:
+                client_id, voucher = pickle.loads(payload)
+                server.vouchers.append(server.registry.handle(client_id), voucher)
+                server.cur_id = max(server.cur_id, voucher.id + 1)
+            elif kind == STATE:
+                client_id, state, rows = pickle.loads(payload)
+                server.registry.states[server.registry.handle(client_id)] = state
+                server.vouchers.mark_processed(np.frombuffer(rows, dtype=np.int64))
+        server.auto_process = auto_process
+        print(f"replayed {cnt} log records")
+
+    def log_client_add(self, client):
+        """Logs the registration of a client with its secrets"""
+        self.log.append(CLIENT_ADD, pickle.dumps(client.keys(), protocol=pickle.HIGHEST_PROTOCOL))
+
+    def log_client_delete(self, client_id):
+        """Logs the deletion of a client, durable before its vouchers are dropped from the columns"""
+        self.log.append(CLIENT_DELETE, client_id.encode())
+        self.log.commit()
+
+    def log_voucher(self, client_id, voucher):
+        """Logs a received voucher in the binary format, vouchers with JSON ciphertexts are pickled"""
+        if isinstance(voucher.ct1, str) or isinstance(voucher.ct2, str) or isinstance(voucher.rct, str):
+            self.log.append(LEGACY_VOUCHER, pickle.dumps((client_id, voucher), protocol=pickle.HIGHEST_PROTOCOL))
+        else:
+            self.log.append(VOUCHER, pack_str(client_id) + voucher.to_bytes())
+
+    def log_state(self, client_id, state, rows):
+        """Logs the processing state of a client and the rows it processed"""
+        rows = np.asarray(rows, dtype=np.int64).tobytes()
+        self.log.append(STATE, pickle.dumps((client_id, state, rows), protocol=pickle.HIGHEST_PROTOCOL))
+
+    def commit(self):
+        """Makes all logged records durable"""
+        self.log.commit()
+
+    def close(self):
+        """Commits and closes the log"""
+        if self.log is not None:
+            self.log.close()
+            self.log = None
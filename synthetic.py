@@ -0,0 +1,65 @@
+"""Synthetic malicious sets, clients and triples for benchmarks and load tests, without images or NeuralHash"""
+import os
+import random
+import tempfile
+
+import util
+
+from client import Client
+from Crypto.Random import get_random_bytes
+from server import Server
+
+
+def use_temp_root(prefix="tpsi-"):
+    """Points all files of util to a new temporary root directory and returns it"""
+    root = tempfile.mkdtemp(prefix=prefix).replace(os.sep, "/") + "/"
+    util.root_dir = root
+    util.clients_dir = root + "Clients/"
+    util.mal_img_dir = root + "Malicious-Images/"
+    util.dec_img_dir = root + "Decrypted-Images/"
+    util.nnhash_cache_path = root + "nnhash-cache.db"
+    util.ad_segment_path = root + "ad-segment.dat"
+    util.state_dir = root + "State/"
+    util.pdata_path = root + "pdata.bin"
+    for d in (util.clients_dir, util.mal_img_dir, util.dec_img_dir):
+        os.mkdir(d)
+    return root
+
+
+def hashes(n):
+    """Returns n random 96-bit NeuralHash-like hex hashes"""
+    return [f"{random.getrandbits(96):024x}" for _ in range(n)]
+
+
+def server(n, t=3, name="Synthetic"):
+    """Sets up a server with n random hashes as X and threshold t"""
+    s = Server(name, X=hashes(n))
+    s.t = t
+    return s
+
+
+def clients(s, n, prefix="client"):
+    """Registers n new clients, their directories are not created"""
+    cs = [Client(f"{prefix}-{i}", s) for i in range(n)]
+    s.add_clients(cs, create_dirs=False)
+    return cs
+
+
+def matching(s):
+    """Returns the hashes of X that are in the cuckoo table, their vouchers decrypt"""
+    return [x for x in s.cuckoo_table if x is not None]
+
+
+def triples(s, m, match_fraction=0.0, ad_size=1024):
+    """Returns m (y, id, ad) triples with fresh IDs, about match_fraction of them match X with distinct hashes"""
+    M = matching(s)
+    random.shuffle(M)
+    res = list()
+    for i in range(m):
+        if len(M) > 0 and random.random() < match_fraction:
+            y = M.pop()
+        else:
+            y = f"{random.getrandbits(96):024x}"
+        res.append((y, s.cur_id, get_random_bytes(ad_size)))
+        s.inc_cur_id()
+    return res
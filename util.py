@@ -1,59 +1,162 @@
 import hashlib
 import json
 import hmac
+import os
+import struct
+import numpy as np
 
-from base64 import b64encode, b64decode
+from base64 import b64decode
 from Crypto.Cipher import AES
 from Crypto.PublicKey import ECC
 from Crypto.Random import get_random_bytes
 from math import ceil
 
+import ecc
+import metrics
+import shamir
+import wire
+
 # root directory (change this for different saving folder)
 root_dir = "C:/Apple-CSAM-Files/"
 clients_dir = root_dir + "Clients/"
 mal_img_dir = root_dir + "Malicious-Images/"
 dec_img_dir = root_dir + "Decrypted-Images/"
+nnhash_cache_path = root_dir + "nnhash-cache.db"
+ad_segment_path = root_dir + "ad-segment.dat"
+state_dir = root_dir + "State/"
+pdata_path = root_dir + "pdata.bin"
+
+# console output, messages about single triples and vouchers are only printed at DEBUG
+QUIET, INFO, DEBUG = 0, 1, 2
+log_level = INFO
 
 # Initialize needed cryptographic values and functions
 hash_func_list = [hashlib.sha1, hashlib.sha256, hashlib.md5, hashlib.sha3_224,
                   hashlib.sha3_256, hashlib.sha3_384, hashlib.sha3_512]
 dhf_l = (2 ** 64) - 59
-sh_p = 340282366920938463463374607431768211297
-ecc_p = 115792089210356248762697446949407573530086143415290314195533631308867097853951
-ecc_q = 115792089210356248762697446949407573529996955224135760342422259061068512044369
-ecc_gen_x = 0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296
-ecc_gen_y = 0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5
+sh_p = shamir.p
+ecc_p = ecc.p
+ecc_q = ecc.q
+ecc_gen_x, ecc_gen_y = ecc.G
 ecc_gen = ECC.EccPoint(x=int(ecc_gen_x), y=int(ecc_gen_y), curve='p256')
 
 
 def aes128_enc(key, data):
-    """Encryption using AES128-GCM with 96-bit nonce"""
-    header = b"header"
+    """Encryption using AES128-GCM with 96-bit nonce, returns the binary ciphertext of wire.py"""
+    if metrics.enabled:
+        metrics.inc("aes_gcm_total", op="encrypt")
     nonce = get_random_bytes(12)
     cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-    cipher.update(header)
     ciphertext, tag = cipher.encrypt_and_digest(data)
+    return wire.encode_ciphertext(nonce, tag, ciphertext)
 
-    json_k = ['nonce', 'header', 'ciphertext', 'tag']
-    json_v = [b64encode(x).decode('utf-8') for x in [cipher.nonce, header, ciphertext, tag]]
-    cipher_json = json.dumps(dict(zip(json_k, json_v)))
-    return cipher_json
 
-
-def aes128_dec(key, cipher_json):
-    """Decryption using AES128-GCM with 96-bit nonce"""
+def aes128_dec(key, ct):
+    """Decryption using AES128-GCM with 96-bit nonce, of binary or old JSON ciphertexts"""
+    if metrics.enabled:
+        metrics.inc("aes_gcm_total", op="decrypt")
     try:
-        b64 = json.loads(cipher_json)
+        if wire.is_binary(ct):
+            nonce, tag, body, _ = wire.parse_ciphertext(ct)
+            cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+            return cipher.decrypt_and_verify(body, tag)
+        b64 = json.loads(ct)
         json_k = ['nonce', 'header', 'ciphertext', 'tag']
         jv = {k: b64decode(b64[k]) for k in json_k}
         cipher = AES.new(key, AES.MODE_GCM, nonce=jv['nonce'])
         cipher.update(jv['header'])
         data = cipher.decrypt_and_verify(jv['ciphertext'], jv['tag'])
-    except (ValueError, KeyError):
+    except (ValueError, KeyError, TypeError, struct.error):
+        if metrics.enabled:
+            metrics.inc("aes_gcm_failures_total")
         return None
     return data
 
 
+def aes128_enc_stream(key, f, id, chunk_size=1 << 16):
+    """Encrypts a file object chunk by chunk for the triple with the given ID, yields the stream header and every
+    chunk with its tag"""
+    prefix = get_random_bytes(8)
+    header = wire.STREAM_HEADER.pack(wire.STREAM_VERSION, prefix, chunk_size)
+    yield header
+    i = 0
+    chunk = f.read(chunk_size)
+    while True:
+        # read ahead to know if this is the last chunk
+        following = f.read(chunk_size)
+        cipher = AES.new(key, AES.MODE_GCM, nonce=wire.chunk_nonce(prefix, i))
+        cipher.update(wire.chunk_aad(header, id, len(following) == 0))
+        ciphertext, tag = cipher.encrypt_and_digest(chunk)
+        yield ciphertext + tag
+        if len(following) == 0:
+            return
+        chunk = following
+        i += 1
+
+
+def stream_length(size, chunk_size=1 << 16):
+    """Returns the length of the streamed ciphertext of size plaintext bytes"""
+    chunks = max(1, -(-size // chunk_size))
+    return wire.STREAM_HEADER.size + size + chunks * wire.TAG_LEN
+
+
+def aes128_dec_stream(key, f, length, id):
+    """Decrypts a streamed ciphertext of the given length and triple ID from a file object, yields the plaintext
+    chunks, raises ValueError if a chunk is not authentic"""
+    header = f.read(wire.STREAM_HEADER.size)
+    if len(header) != wire.STREAM_HEADER.size:
+        raise ValueError("truncated stream header")
+    version, prefix, chunk_size = wire.STREAM_HEADER.unpack(header)
+    if version != wire.STREAM_VERSION:
+        raise ValueError("unknown stream version")
+    remaining = length - wire.STREAM_HEADER.size
+    i = 0
+    while True:
+        block = f.read(min(remaining, chunk_size + wire.TAG_LEN))
+        remaining -= len(block)
+        if len(block) < wire.TAG_LEN:
+            raise ValueError("truncated stream")
+        cipher = AES.new(key, AES.MODE_GCM, nonce=wire.chunk_nonce(prefix, i))
+        cipher.update(wire.chunk_aad(header, id, remaining == 0))
+        yield cipher.decrypt_and_verify(block[:-wire.TAG_LEN], block[-wire.TAG_LEN:])
+        if remaining == 0:
+            return
+        i += 1
+
+
+def save_image_stream(key, segment_path, adref, id, path, sync=False):
+    """Decrypts a streamed AD from the segment straight into the image file of the given ID, as save_image
+    through a temporary file, returns the file path or None if the AD is not authentic, raises OSError if
+    the image could not be written"""
+    dst = f"{path}{id}.png"
+    tmp = dst + ".tmp"
+    offset, length = adref
+    try:
+        with open(segment_path, 'rb') as src, open(tmp, 'wb') as out:
+            src.seek(offset)
+            for chunk in aes128_dec_stream(key, src, length, id):
+                out.write(chunk)
+            if sync:
+                out.flush()
+                os.fsync(out.fileno())
+        os.replace(tmp, dst)
+    except (ValueError, OSError) as exe:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        if isinstance(exe, OSError):
+            raise
+        return None
+    return dst
+
+
+def log(msg, level=DEBUG):
+    """Prints a message if the log level is at least level"""
+    if log_level >= level:
+        print(msg)
+
+
 def calc_prf(fkey, id):
     """PRF for calculating x, z, x', r' using HMAC"""
     # x, z, x', r' el_of F^2_sh * X * R, X is domain of DHF, R is range of DHF
@@ -78,10 +181,7 @@ def init_sh_poly(adkey, t):
 
 def calc_poly(x, pol):
     """Calculates the result of a polynomial for given x and coefficients"""
-    res = 0
-    for i in range(0, len(pol)):
-        res += pol[i] * (x ** i)
-    return res % sh_p
+    return shamir.evaluate(pol, x)
 
 
 def calc_h(u, n_dash, h1_i, h2_i):
@@ -94,11 +194,25 @@ def calc_h(u, n_dash, h1_i, h2_i):
     return out1, out2
 
 
+def calc_h_many(xs, n_dash, h_i):
+    """Calculates the cuckoo table hash h_i of many values at once, same results as calc_h"""
+    base = hmac.new(b'password', digestmod=hash_func_list[h_i])
+    out = np.empty(len(xs), dtype=np.int64)
+    for i, u in enumerate(xs):
+        h = base.copy()
+        h.update(u.encode())
+        out[i] = int.from_bytes(h.hexdigest().encode(), "big") % n_dash
+    return out
+
+
+def calc_H_int(x):
+    """Calculates the scalar h with H(x) = h * G"""
+    return int.from_bytes(x.encode(), "big") % ecc_q
+
+
 def calc_H(x):
     """Calculates the hash for hash function H"""
-    int_x = int.from_bytes(x.encode(), "big") % ecc_q
-    h = int_x * ecc_gen
-    return h
+    return ecc.mul_base(calc_H_int(x))
 
 
 def hmac_sha256(key, data):
@@ -109,9 +223,11 @@ def hmac_sha256(key, data):
 def calc_H_dash(ikm):
     """Calculates the hash for hash function H' using HKDF
         Source: https://en.wikipedia.org/wiki/HKDF"""
+    if metrics.enabled:
+        metrics.inc("hkdf_total")
     salt = b""
     info = b""
-    ikm_bytes = int(ikm.x).to_bytes(32, "big")
+    ikm_bytes = int(ikm[0]).to_bytes(32, "big")
     length = 16
     hash_len = 32
     if len(salt) == 0:
@@ -125,25 +241,46 @@ def calc_H_dash(ikm):
     return okm[:length]
 
 
+def parse_share(sh):
+    """Returns a shamir share as (x, z) tuple, shares of old vouchers are JSON strings"""
+    if isinstance(sh, str):
+        sh = json.loads(sh)
+        return sh['x'], sh['z']
+    return sh
+
+
 def recon_adkey(shares):
     """Reconstructs the adkey using a distinct number of shamir shares > t"""
-    values = list()
-    for s in shares:
-        sh = json.loads(s)
-        values.append((sh['x'], sh['z']))
-    adkey = 0
-    for v in values:
-        temp = 1
-        for other in values:
-            if v is not other:
-                temp = (temp * (0 - other[0] * pow(v[0] - other[0], -1, sh_p))) % sh_p
-        temp = (temp * v[1]) % sh_p
-        adkey = (adkey + temp) % sh_p
-    return adkey
-
-
-def save_image(tup, path):
-    """Saves an image to a given path"""
-    f = open(f"{path}{tup[0]}.png", 'wb')
-    f.write(tup[1])
-    f.close()
+    return shamir.interpolate([parse_share(s) for s in shares])
+
+
+def chunked(iterable, size):
+    """Splits an iterable into lists of at most size items"""
+    chunk = list()
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = list()
+    if len(chunk) > 0:
+        yield chunk
+
+
+def save_image(tup, path, sync=False):
+    """Saves an image to a given path, through a temporary file so that the image is never partial,
+    with sync its data is on disk before it appears under its name"""
+    dst = f"{path}{tup[0]}.png"
+    tmp = dst + ".tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(tup[1])
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, dst)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,202 @@
+import os
+
+import numpy as np
+import wire
+
+from client import Voucher
+
+# a binary ciphertext of a 16-byte rkey
+CT_LEN = wire.RKEY_CT_LEN
+
+
+class Column:
+    """Growable array, in memory or memory-mapped from a file"""
+    def __init__(self, dtype, width=None, path=None, capacity=1024):
+        self.dtype = np.dtype(dtype)
+        self.width = width  # bytes per row of a fixed-width byte column
+        self.path = path
+        self.capacity = 0
+        self.data = None
+        self.resize(capacity)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            # a memory-mapped column is opened again from its file
+            self.data.flush()
+            state['data'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.data is None:
+            self.data = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=self.shape(self.capacity))
+
+    def shape(self, capacity):
+        """Returns the array shape for the given number of rows"""
+        return (capacity,) if self.width is None else (capacity, self.width)
+
+    def resize(self, capacity):
+        """Grows the array to the given number of rows, keeping its contents"""
+        if self.path is None:
+            data = np.zeros(self.shape(capacity), dtype=self.dtype)
+            if self.data is not None:
+                data[:self.capacity] = self.data
+        else:
+            if self.data is None:
+                open(self.path, 'wb').close()
+            else:
+                self.data.flush()
+            row = self.dtype.itemsize * (self.width or 1)
+            with open(self.path, 'r+b') as f:
+                f.truncate(capacity * row)
+            data = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=self.shape(capacity))
+        self.data = data
+        self.capacity = capacity
+
+    def reserve(self, n):
+        """Makes room for n rows, doubling the capacity"""
+        if n > self.capacity:
+            self.resize(max(n, 2 * self.capacity))
+
+
+class VoucherStore:
+    """Vouchers of all clients in contiguous columns: fixed-width Q1/Q2 and ct1/ct2, integer ID, client handle
+    and adref columns, and an arena holding the variable-length rct ciphertexts back to back
+
+    Rows are never changed after they were appended. The processed flags change with every run and always stay
+    in memory, only the flags behind first_pending are pickled."""
+    def __init__(self, path=None):
+        self.path = path  # directory of the column files, None keeps the columns in memory
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+        def column(name, dtype, width=None):
+            return Column(dtype, width, None if path is None else os.path.join(path, name))
+
+        self.id = column("id.bin", np.uint64)
+        self.client = column("client.bin", np.int64)  # client handle
+        self.Q1 = column("q1.bin", np.uint8, wire.POINT_LEN)
+        self.Q2 = column("q2.bin", np.uint8, wire.POINT_LEN)
+        self.ct1 = column("ct1.bin", np.uint8, CT_LEN)
+        self.ct2 = column("ct2.bin", np.uint8, CT_LEN)
+        self.adref = column("adref.bin", np.int64, 2)  # (offset, length) of a streamed adct, -1 if none
+        self.rct_end = column("rct-end.bin", np.int64)  # end of every rct in the arena
+        self.processed = Column(np.bool_)
+        self.arena = column("rct.bin", np.uint8)
+        self.columns = [self.id, self.client, self.Q1, self.Q2, self.ct1, self.ct2, self.adref, self.rct_end,
+                        self.processed]
+        self.n = 0  # number of vouchers
+        self.arena_size = 0  # bytes used in the arena
+        self.first_pending = 0  # all vouchers before this row are processed
+        self.legacy = dict()  # vouchers with JSON ciphertexts by row, they do not fit into the columns
+        self.deleted = set()  # handles of deleted clients, their rows are skipped instead of rewritten
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # every row before first_pending is processed, so a snapshot does not grow with the stored vouchers
+        state['processed'] = self.processed.data[self.first_pending:self.n].copy()
+        state['columns'] = None
+        return state
+
+    def __setstate__(self, state):
+        tail = state['processed']
+        self.__dict__.update(state)
+        self.processed = Column(np.bool_, capacity=max(self.n, 1024))
+        self.processed.data[:self.first_pending] = True
+        self.processed.data[self.first_pending:self.n] = tail
+        self.columns = [self.id, self.client, self.Q1, self.Q2, self.ct1, self.ct2, self.adref, self.rct_end,
+                        self.processed]
+
+    def __len__(self):
+        return self.n
+
+    def append(self, handle, voucher):
+        """Appends a voucher of the client with the given handle, returns its row"""
+        row = self.n
+        for c in self.columns:
+            c.reserve(row + 1)
+        self.client.data[row] = handle
+        self.processed.data[row] = False
+        if not (wire.is_binary(voucher.ct1) and wire.is_binary(voucher.ct2) and wire.is_binary(voucher.rct)):
+            self.legacy[row] = voucher
+            self.rct_end.data[row] = self.arena_size
+            self.n = row + 1
+            return row
+        start = self.arena_size
+        end = start + len(voucher.rct)
+        self.arena.reserve(end)
+        self.arena.data[start:end] = np.frombuffer(voucher.rct, dtype=np.uint8)
+        self.id.data[row] = voucher.id
+        self.Q1.data[row] = np.frombuffer(wire.encode_point(voucher.Q1), dtype=np.uint8)
+        self.Q2.data[row] = np.frombuffer(wire.encode_point(voucher.Q2), dtype=np.uint8)
+        self.ct1.data[row] = np.frombuffer(voucher.ct1, dtype=np.uint8)
+        self.ct2.data[row] = np.frombuffer(voucher.ct2, dtype=np.uint8)
+        self.adref.data[row] = voucher.adref if voucher.adref is not None else (-1, -1)
+        self.rct_end.data[row] = end
+        self.arena_size = end
+        self.n = row + 1
+        return row
+
+    def get(self, row):
+        """Returns the voucher in the given row, the ciphertexts are views into the columns"""
+        if row in self.legacy:
+            return self.legacy[row]
+        start = int(self.rct_end.data[row - 1]) if row > 0 else 0
+        end = int(self.rct_end.data[row])
+        offset, length = self.adref.data[row].tolist()
+        return Voucher(int(self.id.data[row]),
+                       wire.decode_point(self.Q1.data[row].data), self.ct1.data[row].data,
+                       wire.decode_point(self.Q2.data[row].data), self.ct2.data[row].data,
+                       self.arena.data[start:end].data, None if offset < 0 else (offset, length))
+
+    def get_many(self, rows):
+        """Returns the vouchers in the given rows"""
+        return [self.get(row) for row in rows]
+
+    def rows(self, handle):
+        """Returns the rows of all vouchers of a client"""
+        return np.flatnonzero(self.client.data[:self.n] == handle)
+
+    def count(self, handle):
+        """Returns the number of vouchers of a client"""
+        return int(np.count_nonzero(self.client.data[:self.n] == handle))
+
+    def pending(self):
+        """Returns the unprocessed rows grouped by client handle, in order of arrival within every client,
+        rows of deleted clients are marked as processed when the scan passes them"""
+        start = self.first_pending
+        rows = start + np.flatnonzero(~self.processed.data[start:self.n])
+        clients = self.client.data[rows]
+        if len(self.deleted) > 0:
+            gone = np.isin(clients, np.fromiter(self.deleted, np.int64, len(self.deleted)))
+            if gone.any():
+                self.processed.data[rows[gone]] = True
+                rows = rows[~gone]
+                clients = clients[~gone]
+        order = np.argsort(clients, kind='stable')
+        rows = rows[order]
+        clients = clients[order]
+        bounds = np.flatnonzero(np.diff(clients)) + 1
+        return {int(g[0]): r for g, r in zip(np.split(clients, bounds), np.split(rows, bounds)) if len(r) > 0}
+
+    def mark_processed(self, rows):
+        """Marks rows as processed and skips the processed prefix in later scans"""
+        self.processed.data[rows] = True
+        rest = np.flatnonzero(~self.processed.data[self.first_pending:self.n])
+        self.first_pending = self.first_pending + int(rest[0]) if len(rest) > 0 else self.n
+
+    def delete_client(self, handle):
+        """Drops the vouchers of a deleted client, handles are never reused so its rows are only skipped"""
+        self.deleted.add(handle)
+
+    def flush(self):
+        """Writes the memory-mapped columns to disk"""
+        for c in self.columns + [self.arena]:
+            if c.path is not None:
+                c.data.flush()
+
+    def nbytes(self):
+        """Returns the bytes used by the stored vouchers"""
+        row = sum(c.dtype.itemsize * (c.width or 1) for c in self.columns)
+        return self.n * row + self.arena_size
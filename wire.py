@@ -0,0 +1,130 @@
+import struct
+
+import ecc
+
+# binary ciphertext: version byte, 96-bit nonce, 128-bit tag, 4-byte body length, body
+VERSION = 1
+CT_HEADER = struct.Struct(">B12s16sI")
+POINT_LEN = 33
+ID = struct.Struct(">Q")
+SHARE = struct.Struct(">16s16s")
+LENGTH = struct.Struct(">I")
+RKEY_CT_LEN = CT_HEADER.size + 16  # binary ciphertext of a 16-byte rkey, ct1 and ct2 of every voucher
+
+
+def encode_point(P):
+    """Encodes an affine point in 33-byte compressed SEC1 form, the point at infinity as zeros"""
+    if P is None:
+        return bytes(POINT_LEN)
+    x, y = P
+    return bytes([2 + (y & 1)]) + x.to_bytes(32, "big")
+
+
+def decode_point(buf):
+    """Decodes a compressed point, y is the square root of x^3 - 3x + b with the encoded parity"""
+    prefix = buf[0]
+    x = int.from_bytes(buf[1:POINT_LEN], "big")
+    if prefix == 0:
+        return None
+    if prefix not in (2, 3) or x >= ecc.p:
+        raise ValueError("invalid point encoding")
+    rhs = (x * x * x - 3 * x + ecc.b) % ecc.p
+    # p = 3 mod 4, so a square root is a power of (p + 1) / 4
+    y = pow(rhs, (ecc.p + 1) // 4, ecc.p)
+    if y * y % ecc.p != rhs:
+        raise ValueError("point is not on the curve")
+    if y & 1 != prefix & 1:
+        y = ecc.p - y
+    return x, y
+
+
+def encode_ciphertext(nonce, tag, body):
+    """Encodes an AES-GCM ciphertext"""
+    return CT_HEADER.pack(VERSION, nonce, tag, len(body)) + body
+
+
+def is_binary(ct):
+    """Checks if a ciphertext is in the binary format instead of the old JSON format"""
+    return not isinstance(ct, str) and len(ct) > 0 and ct[0] == VERSION
+
+
+def parse_ciphertext(buf, offset=0):
+    """Parses a ciphertext at offset, returns nonce, tag, the body as a memoryview into buf and the offset
+    behind the ciphertext"""
+    mv = memoryview(buf)
+    version, nonce, tag, length = CT_HEADER.unpack_from(mv, offset)
+    if version != VERSION:
+        raise ValueError("unknown ciphertext version")
+    start = offset + CT_HEADER.size
+    end = start + length
+    if end > len(mv):
+        raise ValueError("truncated ciphertext")
+    return nonce, tag, mv[start:end], end
+
+
+def split_ciphertext(buf, offset=0):
+    """Returns the ciphertext at offset as a memoryview and the offset behind it"""
+    end = parse_ciphertext(buf, offset)[3]
+    return memoryview(buf)[offset:end], end
+
+
+def encode_rct(adct, sh_x, sh_z):
+    """Encodes the plaintext of rct, the length-prefixed adct followed by the share (x, z)"""
+    return b"".join((LENGTH.pack(len(adct)), adct, SHARE.pack(sh_x.to_bytes(16, "big"), sh_z.to_bytes(16, "big"))))
+
+
+def decode_rct(buf):
+    """Decodes the plaintext of rct, returns adct as a memoryview and the share as an (x, z) tuple"""
+    mv = memoryview(buf)
+    length = LENGTH.unpack_from(mv)[0]
+    end = LENGTH.size + length
+    if end + SHARE.size != len(mv):
+        raise ValueError("invalid rct length")
+    x, z = SHARE.unpack_from(mv, end)
+    return mv[LENGTH.size:end], (int.from_bytes(x, "big"), int.from_bytes(z, "big"))
+
+
+# streamed AD: version byte, 64-bit nonce prefix and chunk size, then every chunk with its 128-bit tag
+STREAM_VERSION = 3
+STREAM_HEADER = struct.Struct(">B8sI")
+TAG_LEN = 16
+ADREF = struct.Struct(">QQ")
+
+
+def chunk_nonce(prefix, i):
+    """Nonce of chunk i of a streamed AD"""
+    return prefix + i.to_bytes(4, "big")
+
+
+def chunk_aad(header, id, last):
+    """Authenticated data of a chunk: the stream header and the triple ID, so that an adref pointing at another
+    AD in the segment does not decrypt, and a mark of the last chunk, so that truncation is detected"""
+    return header + ID.pack(id) + (b"\x01" if last else b"\x00")
+
+
+# frames of the ingestion service: 4-byte payload length and a kind byte, then the payload
+FRAME = struct.Struct(">IB")
+MAX_FRAME = 1 << 26
+HELLO = 1  # client ID as UTF-8, following vouchers belong to this client
+GET_PARAMS = 2
+PARAMS = 3  # PARAMS_HEADER, then pdata as compressed points
+RESERVE = 4  # COUNT, asks for a range of triple IDs
+IDS = 5  # first ID and COUNT of a reserved range
+AD = 6  # AD_NUM, then a block of a streamed AD started by AD_START
+AD_END = 7  # AD_NUM, the streamed AD is complete
+VOUCHER = 8  # voucher
+VOUCHER_AD = 9  # AD_NUM of the streamed AD of the voucher, then the voucher
+ACK = 10  # COUNT of vouchers handled on this connection, then the pdata version of the server as COUNT
+ERROR = 11  # number of the rejected voucher on this connection as COUNT, then the reason as UTF-8, for a
+# rejected HELLO the number of the following voucher
+AD_START = 12  # AD_NUM and the length of a streamed AD as COUNT, precedes its blocks
+PARAMS_HEADER = struct.Struct(">IIIIQ")  # t, n_dash, h1_index, h2_index, pdata version
+AD_NUM = struct.Struct(">Q")
+COUNT = struct.Struct(">Q")
+MAX_AD = 1 << 32  # length of a streamed AD the service accepts
+
+
+def encode_frame(kind, *parts):
+    """Encodes a frame with the concatenated parts as payload"""
+    payload = b"".join(parts)
+    return FRAME.pack(len(payload), kind) + payload